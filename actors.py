@@ -0,0 +1,225 @@
+# -----------------------------------
+# multi-process actor pool: each worker runs its own car_sim_env with a CPU
+# copy of the DQN and streams transitions to the learner through a
+# shared-memory ring buffer; the learner broadcasts new policy weights
+# -----------------------------------
+import ctypes
+import multiprocessing as mp
+import random
+import time
+
+import numpy as np
+import torch
+
+from car_parking_env import car_sim_env
+from car_parking_env import Agent
+from model.model import DQN
+import tools
+import runlog
+
+# per-worker episode counters, cumulative since the worker started
+STAT_FIELDS = ('episodes', 'succ_times', 'hit_wall_times', 'hit_car_times',
+               'num_hit_time_limit', 'num_out_of_time')
+
+
+def _shared_view(raw, dtype, shape):
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+class SharedRing(object):
+    '''
+    Single-producer single-consumer ring of transitions in shared memory.
+    The producer writes a slot and then advances head; the consumer reads
+    the slots between tail and head and then advances tail, so neither side
+    needs a lock.
+    '''
+    def __init__(self, capacity, img_shape=(60, 80), vec_size=5):
+        self.capacity = capacity
+        self.layout = [('state_img', np.uint8, (capacity,) + tuple(img_shape)),
+                       ('next_state_img', np.uint8, (capacity,) + tuple(img_shape)),
+                       ('state_tuple', np.float32, (capacity, vec_size)),
+                       ('next_state_tuple', np.float32, (capacity, vec_size)),
+                       ('action', np.int8, (capacity,)),
+                       ('reward', np.float32, (capacity,))]
+        self.raw = {}
+        for name, dtype, shape in self.layout:
+            self.raw[name] = mp.RawArray(ctypes.c_uint8, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        self.head = mp.RawValue(ctypes.c_int64, 0)  # transitions written
+        self.tail = mp.RawValue(ctypes.c_int64, 0)  # transitions read
+        self._make_views()
+
+    def _make_views(self):
+        for name, dtype, shape in self.layout:
+            setattr(self, name, _shared_view(self.raw[name], dtype, shape))
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        for name, _, _ in self.layout:
+            d.pop(name, None)
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._make_views()
+
+    def put(self, state_img, state_tuple, action, reward, next_state_img, next_state_tuple):
+        head = self.head.value
+        if head - self.tail.value >= self.capacity:
+            return False
+        i = head % self.capacity
+        self.state_img[i] = state_img
+        self.state_tuple[i] = state_tuple
+        self.action[i] = action
+        self.reward[i] = reward
+        self.next_state_img[i] = next_state_img
+        self.next_state_tuple[i] = next_state_tuple
+        self.head.value = head + 1
+        return True
+
+    def drain(self, memory):
+        # push every pending transition into memory, return how many
+        tail = self.tail.value
+        head = self.head.value
+        for k in range(tail, head):
+            i = k % self.capacity
+            memory.push(tools.state(self.state_img[i], self.state_tuple[i]),
+                        int(self.action[i]),
+                        tools.state(self.next_state_img[i], self.next_state_tuple[i]),
+                        float(self.reward[i]))
+        self.tail.value = head
+        return head - tail
+
+
+class SharedWeights(object):
+    '''
+    Flat float32 copy of a network's state_dict in shared memory, with a
+    version counter bumped on every publish().
+    '''
+    def __init__(self, net):
+        self.entries = [(name, tuple(t.shape)) for name, t in net.state_dict().items()]
+        n_values = sum(int(np.prod(shape)) for _, shape in self.entries)
+        self.raw = mp.RawArray(ctypes.c_float, n_values)
+        self.version = mp.RawValue(ctypes.c_int64, 0)
+        self.lock = mp.Lock()
+
+    def publish(self, net):
+        flat = np.frombuffer(self.raw, dtype=np.float32)
+        values = [t.detach().cpu().numpy().reshape(-1) for t in net.state_dict().values()]
+        with self.lock:
+            np.concatenate(values, out=flat)
+            self.version.value += 1
+
+    def load(self, net):
+        flat = np.frombuffer(self.raw, dtype=np.float32)
+        with self.lock:
+            flat = flat.copy()
+            version = self.version.value
+        state_dict = {}
+        offset = 0
+        for name, shape in self.entries:
+            size = int(np.prod(shape))
+            state_dict[name] = torch.from_numpy(flat[offset:offset + size].reshape(shape))
+            offset += size
+        net.load_state_dict(state_dict)
+        return version
+
+
+def select_action(net, state, epsilon):
+    # epsilon-greedy like LearningAgent.get_action, returns the action index
+    if random.random() > epsilon:
+        with torch.no_grad():
+            q_values = net(tools.frame_to_float(state.state_img).view(1, 1, 60, 80), state.state_tuple.view(1, 5))
+        return int(q_values.argmax(dim=1))
+    return random.randrange(len(car_sim_env.valid_actions))
+
+
+def actor_loop(worker_id, ring, weights, epsilon, stats, stop, env_kwargs, seed):
+    torch.set_num_threads(1)
+    runlog.configure()
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    env = car_sim_env(**env_kwargs)
+    net = DQN(vec_size=5, n_actions=9)
+    net.eval()
+    version = weights.load(net)
+    agent = Agent()
+
+    while not stop.is_set():
+        env.reset()
+        env.update_screen()
+        agent.state = tools.state(env.get_screen(), torch.Tensor(env.sense()))
+        while not env.done and not stop.is_set():
+            if weights.version.value != version:
+                version = weights.load(net)
+            action_idx = select_action(net, agent.state, epsilon.value)
+            next_pose, reward = env.act(agent, car_sim_env.valid_actions[action_idx])
+            env.update_screen()
+            next_state = tools.state(env.get_screen(), torch.Tensor(next_pose))
+
+            while not ring.put(tools.frame_to_uint8(agent.state.state_img), agent.state.state_tuple.numpy(),
+                               action_idx, reward,
+                               tools.frame_to_uint8(next_state.state_img), next_state.state_tuple.numpy()):
+                # the learner is behind: wait for it to drain the ring
+                if stop.is_set():
+                    return
+                time.sleep(0.001)
+            agent.state = next_state
+            env.step()
+
+        with stats.get_lock():
+            stats[:] = [stats[0] + 1] + [getattr(env, name) for name in STAT_FIELDS[1:]]
+
+
+class ActorPool(object):
+    '''
+    n_workers actor processes, each with its own SharedRing and episode
+    counters. The learner calls drain() to move transitions into its replay
+    memory, broadcast() to publish new weights and set_epsilon() to steer
+    exploration.
+    '''
+    def __init__(self, n_workers, policy_net, env_kwargs=None, ring_capacity=1024, seed=0):
+        env_kwargs = env_kwargs or {'render_backend': 'numpy'}
+        self.weights = SharedWeights(policy_net)
+        self.weights.publish(policy_net)
+        self.epsilon = mp.RawValue(ctypes.c_double, 1.0)
+        self.stop_event = mp.Event()
+        self.rings = [SharedRing(ring_capacity) for _ in range(n_workers)]
+        # locked: the learner must not sum a half-written row
+        self.stats = [mp.Array(ctypes.c_int64, len(STAT_FIELDS)) for _ in range(n_workers)]
+        self.workers = []
+        for i in range(n_workers):
+            p = mp.Process(target=actor_loop, name='actor{}'.format(i),
+                           args=(i, self.rings[i], self.weights, self.epsilon, self.stats[i],
+                                 self.stop_event, env_kwargs, seed + i))
+            p.daemon = True
+            self.workers.append(p)
+
+    def start(self):
+        for p in self.workers:
+            p.start()
+
+    def stop(self):
+        self.stop_event.set()
+        for p in self.workers:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+
+    def drain(self, memory):
+        return sum(ring.drain(memory) for ring in self.rings)
+
+    def broadcast(self, net):
+        self.weights.publish(net)
+
+    def set_epsilon(self, epsilon):
+        self.epsilon.value = epsilon
+
+    def episode_stats(self):
+        # counters summed over the workers, keyed by STAT_FIELDS
+        totals = [0] * len(STAT_FIELDS)
+        for s in self.stats:
+            with s.get_lock():
+                totals = [t + v for t, v in zip(totals, s[:])]
+        return dict(zip(STAT_FIELDS, totals))
@@ -3,26 +3,33 @@ import time
 import random
 from car_parking_env import car_sim_env
 from car_parking_env import Agent
-import os, sys, termios, tty
+import os, sys
 import re
 from collections import namedtuple
-import cPickle
 import threading
+import copy
 import argparse
-from PIL import Image
-from shutil import copyfile
 from datetime import datetime
 
 from model.model import DQN
+from model.model import build_net
 from tools import print_log
 from tools import ReplayMemory
+from tools import ArrayReplayMemory
+from tools import MmapReplayMemory
+from tools import DedupReplayMemory
+from tools import PrioritizedReplayMemory
+from tools import BatchPrefetcher
+from tools import FrameStack
+from tools import frame_to_float
+import runlog
+# the feature modules (actors, inference, checkpoint, evaluate, profiling)
+# are imported by the code paths that use them
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
-import torchvision.transforms as T
-import torchvision
 
 
 
@@ -37,27 +44,91 @@ parser.add_argument('--TARGET_UPDATE_CYCLE', default=10, type=int, help='Target_
 parser.add_argument('--path', default='./data/', type=str, help='saved state image data_path')
 parser.add_argument('--SAVE_PATH', default='./log/', type=str, help='')
 parser.add_argument('--MEMORY_SIZE', default=10000, type=int, help='ReplayMemory capacity')
+parser.add_argument('--replay', default='array', choices=['array', 'mmap', 'dedup', 'list'], help='replay storage: preallocated uint8 arrays, the same arrays memory-mapped under SAVE_PATH, arrays storing each frame once, or a list of tensor transitions')
 parser.add_argument('--log', default=None, help='open log')
 parser.add_argument('--TEST_INTERVAL', default=100, type=int, help='evaluation inverval')
-
-args = parser.parse_args()
-
-filename = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-log = open(os.path.join(args.SAVE_PATH, 'RLPark_Log_'+filename+'.txt'), 'w')
-args.log = log
+parser.add_argument('--render_backend', default='numpy', choices=car_sim_env.render_backends, help='screen renderer: matplotlib (watchable) or numpy (headless)')
+parser.add_argument('--prioritized', action='store_true', help='prioritized experience replay (needs --replay array or mmap)')
+parser.add_argument('--per_alpha', default=0.6, type=float, help='prioritization exponent')
+parser.add_argument('--per_beta', default=0.4, type=float, help='initial importance-sampling exponent, annealed to 1')
+parser.add_argument('--per_beta_steps', default=100000, type=int, help='optimizer steps over which beta reaches 1')
+parser.add_argument('--actors', default=0, type=int, help='number of actor processes (0: act and learn in one loop)')
+parser.add_argument('--actor_ring_size', default=1024, type=int, help='transitions buffered per actor')
+parser.add_argument('--async_learner', action='store_true', help='run the gradient steps on a background learner thread')
+parser.add_argument('--broadcast_interval', default=100, type=int, help='gradient steps between policy handoffs to the actors / acting loop')
+parser.add_argument('--replay_ratio', default=1.0, type=float, help='gradient steps per environment step in the actor/learner modes')
+parser.add_argument('--prefetch', default=0, type=int, help='minibatches built ahead on a background thread (0: sample in optimize_model)')
+parser.add_argument('--jit_inference', action='store_true', help='pick actions with a traced, frozen copy of the policy net')
+parser.add_argument('--inference_threads', default=0, type=int, help='intra-op threads for torch (0: torch default)')
+parser.add_argument('--observation', default='image', choices=['image', 'pose'], help='image: screen and pose through DQN; pose: the pose vector alone through a small MLP, nothing rendered')
+parser.add_argument('--frame_stack', default=1, type=int, help='frames stacked into each image observation (more than 1 needs --replay dedup)')
+parser.add_argument('--sprite_cache', default=0, type=int, help='agent sprites cached by quantized pose for the numpy renderer (0: draw the exact pose every step)')
+parser.add_argument('--obstacle_field', action='store_true', help='use a precomputed distance field for wall/car collisions')
+parser.add_argument('--field_resolution', default=0.05, type=float, help='obstacle field grid cell size')
+parser.add_argument('--field_approximate', action='store_true', help='decide poses near obstacle boundaries from the field instead of the exact test')
+parser.add_argument('--checkpoint_interval', default=1000, type=int, help='trials between training checkpoints under SAVE_PATH/checkpoints (0: never)')
+parser.add_argument('--checkpoint_keep', default=3, type=int, help='number of checkpoints kept')
+parser.add_argument('--checkpoint_replay', action='store_true', help='also save the replay memory in the checkpoints (copied on the training thread, a stall at each checkpoint)')
+parser.add_argument('--eval_interval', default=0, type=int, help='trials between greedy evaluations of the policy (0: never)')
+parser.add_argument('--eval_episodes', default=50, type=int, help='start poses per greedy evaluation')
+parser.add_argument('--eval_workers', default=2, type=int, help='evaluation processes')
+parser.add_argument('--eval_seed', default=0, type=int, help='seed of the evaluation start poses')
+parser.add_argument('--profile', action='store_true', help='time each phase of the training loop, dumped next to the log')
+parser.add_argument('--profile_interval', default=60.0, type=float, help='seconds between timing dumps')
+parser.add_argument('--log_level', default='info', choices=sorted(runlog.LEVELS, key=runlog.LEVELS.get), help='lowest level of the JSONL records (trace: per step)')
+parser.add_argument('--log_buffer', default=256, type=int, help='JSONL records buffered between writes')
+parser.add_argument('--restore', action='store_true', help='resume from the latest checkpoint under SAVE_PATH/checkpoints')
+
+# set by setup()
+args = None
+log = None
+filename = None
+CHECKPOINT_DIR = None
 
 Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward'))
 state = namedtuple('state', ('state_img', 'state_tuple'))
 state_tuple = namedtuple('state_tuple', ('x', 'y', 'theta_heading', 's', 'theta_steering'))
 
 
-print_log("pytorch version : {}".format(torch.__version__), log)
-print_log("------[Initial parameters]------", log)
-print_log("Initial epsilon: {}".format(args.epsilon), log)
-print_log("Epsilon decay rate: {}".format(args.eps_decay), log)
-print_log("Batch size: {}".format(args.BATCH_SIZE), log)
-print_log("Learning rate: {}".format(args.lrate), log)
-print_log("Discount factor(gamma): {}".format(args.discount), log)
+def setup(argv=None):
+    '''
+    Parses argv (sys.argv[1:] by default) into args and opens the run logs
+    under SAVE_PATH. Importing this module does neither, so that it stays
+    cheap to import; call setup() before building a LearningAgent.
+    '''
+    global args, log, filename, CHECKPOINT_DIR
+    args = parser.parse_args(argv)
+    if args.prioritized and args.replay not in ('array', 'mmap'):
+        parser.error('--prioritized needs --replay array or mmap')
+    if args.actors > 0 and args.replay == 'list':
+        parser.error('--actors needs an array-backed --replay')
+    if args.actors > 0 and args.async_learner:
+        parser.error('--actors already runs the learner apart from acting, drop --async_learner')
+    if args.prefetch > 0 and args.replay == 'list':
+        parser.error('--prefetch needs an array-backed --replay')
+    if args.observation == 'pose' and args.replay == 'dedup':
+        parser.error('--observation pose stores no frames, use --replay array, mmap or list')
+    if args.observation == 'pose' and (args.actors > 0 or args.jit_inference):
+        parser.error('--observation pose works with the single-process loop and eager inference only')
+    if args.frame_stack > 1 and (args.replay != 'dedup' or args.observation == 'pose' or args.actors > 0):
+        parser.error('--frame_stack needs --replay dedup, image observations and no --actors')
+    if args.sprite_cache > 0 and args.render_backend != 'numpy':
+        parser.error('--sprite_cache needs --render_backend numpy')
+
+    filename = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    log = open(os.path.join(args.SAVE_PATH, 'RLPark_Log_'+filename+'.txt'), 'w')
+    args.log = log
+    runlog.configure(os.path.join(args.SAVE_PATH, 'RLPark_Log_'+filename+'.jsonl'), args.log_level, args.log_buffer)
+    CHECKPOINT_DIR = os.path.join(args.SAVE_PATH, 'checkpoints')
+
+    print_log("pytorch version : {}".format(torch.__version__), log)
+    print_log("------[Initial parameters]------", log)
+    print_log("Initial epsilon: {}".format(args.epsilon), log)
+    print_log("Epsilon decay rate: {}".format(args.eps_decay), log)
+    print_log("Batch size: {}".format(args.BATCH_SIZE), log)
+    print_log("Learning rate: {}".format(args.lrate), log)
+    print_log("Discount factor(gamma): {}".format(args.discount), log)
+    return args
 
 #print "==========>", linear1.device
 #print "==========>", self.linear1.weight.device
@@ -91,26 +162,71 @@ class LearningAgent(Agent):
         else :
             print "using cpu..."
 
-        self.memory = ReplayMemory(args.MEMORY_SIZE)
+        # pose-only observations: no screen is rendered or stored
+        self.pose_only = args.observation == 'pose'
+        img_shape = None if self.pose_only else (60, 80)
+        if args.replay == 'array':
+            self.memory = ArrayReplayMemory(args.MEMORY_SIZE, img_shape)
+        elif args.replay == 'mmap':
+            self.memory = MmapReplayMemory(args.MEMORY_SIZE, os.path.join(args.SAVE_PATH, 'replay'), img_shape)
+            if self.memory.resumed:
+                print_log("Resumed replay memory with {} transitions".format(len(self.memory)), log)
+        elif args.replay == 'dedup':
+            self.memory = DedupReplayMemory(args.MEMORY_SIZE, stack=args.frame_stack)
+        else:
+            self.memory = ReplayMemory(args.MEMORY_SIZE)
+        if args.prioritized:
+            self.memory = PrioritizedReplayMemory(self.memory, alpha=args.per_alpha, beta=args.per_beta,
+                                                  beta_steps=args.per_beta_steps)
         
-        self.policy_net = DQN(vec_size=5, n_actions=9).to(self.device)
-        self.target_net = DQN(vec_size=5, n_actions=9).to(self.device)
+        self.policy_net = build_net(args.observation, vec_size=5, n_actions=9,
+                                    frame_stack=args.frame_stack).to(self.device)
+        self.target_net = build_net(args.observation, vec_size=5, n_actions=9,
+                                    frame_stack=args.frame_stack).to(self.device)
+        # the last frame_stack frames make up a state's image
+        self.frame_stack = None
+        if args.frame_stack > 1:
+            self.frame_stack = FrameStack(args.frame_stack, (60, 80), device=self.device)
 #        self.policy_net = DQN(vec_size=5, n_actions=9).cuda()
 #        self.target_net = DQN(vec_size=5, n_actions=9).cuda()
         self.target_net.load_state_dict(self.policy_net.state_dict())
         self.target_net.eval()
         
         self.optimizer = optim.RMSprop(self.policy_net.parameters(), lr= 1e-2)
+
+        # get_action reads acting_net; with the async learner it is a copy of
+        # policy_net that the learner thread replaces, never one it trains
+        self.acting_net = self.policy_net
+        self.async_learner = False
+        self.memory_lock = threading.Lock()
+        # held while the optimizer or a target sync changes the weights
+        self.weights_lock = threading.Lock()
+        from profiling import PhaseTimer
+        self.timer = PhaseTimer(enabled=args.profile,
+                                csv_path=os.path.join(args.SAVE_PATH, 'RLPark_Timing_'+filename+'.csv'),
+                                prom_path=os.path.join(args.SAVE_PATH, 'RLPark_Timing_'+filename+'.prom'),
+                                dump_interval=args.profile_interval)
+        self.prefetcher = None
+        # bumped whenever new weights are published to acting_net
+        self.acting_version = 0
+        self.n_updates = 0
+        self.engine = None
+        if args.jit_inference:
+            from inference import InferenceEngine
+            self.engine = InferenceEngine(self.policy_net, device=self.device,
+                                          num_threads=args.inference_threads or None,
+                                          img_shape=(args.frame_stack, 60, 80))
+            self.engine_version = self.acting_version
+        elif args.inference_threads:
+            torch.set_num_threads(args.inference_threads)
+        self.env_steps = 0
+        self.episode_return = 0.0
+        self.target_sync_requested = False
         print "device", self.device
         print "q net", self.policy_net
         print "target net", self.target_net
 
-        if 1 :
-            self.state_path = 'state.png'
-            
-            init_path = os.path.join(args.path, '../env.png')    
-            cp_path = os.path.join(args.path, self.state_path)
-            copyfile(init_path, cp_path)
+        if not self.pose_only and self.env is not None:
             self.env.update_screen()
 
 #    def load_dataset(self, path):i
@@ -171,34 +287,61 @@ class LearningAgent(Agent):
             self.epsilon *= self.epsilon_decay
         #print "Exploration rate: ", self.epsilon
 
+    def start_learner_thread(self, replay_ratio, publish_interval):
+        self.async_learner = True
+        self.acting_net = copy.deepcopy(self.policy_net)
+        self.learner_thread = threading.Thread(name="learner", target=self.learner_loop,
+                                               args=(replay_ratio, publish_interval))
+        self.learner_thread.daemon = True
+        self.learner_thread.start()
+
+    def start_prefetcher(self, depth):
+        # optimize_model then takes its batches from the prefetcher thread
+        self.prefetcher = BatchPrefetcher(self.memory, args.BATCH_SIZE, self.device,
+                                          depth=depth, lock=self.memory_lock).start()
+
+    def learner_loop(self, replay_ratio, publish_interval):
+        # keeps n_updates at replay_ratio * env_steps at most; acting never waits for it
+        n_updates = 0
+        while True:
+            if self.target_sync_requested:
+                with self.weights_lock:
+                    self.target_net.load_state_dict(self.policy_net.state_dict())
+                self.target_sync_requested = False
+            if len(self.memory) < args.BATCH_SIZE or n_updates >= self.env_steps * replay_ratio:
+                time.sleep(0.001)
+                continue
+            self.optimize_model(self.memory)
+            n_updates += 1
+            if n_updates % publish_interval == 0:
+                # a fresh copy, swapped in with one reference assignment
+                acting_net = copy.deepcopy(self.policy_net)
+                acting_net.eval()
+                self.acting_net = acting_net
+                self.acting_version += 1
+
+    def sync_target(self):
+        if self.async_learner:
+            # the learner thread owns target_net
+            self.target_sync_requested = True
+        else:
+            self.target_net.load_state_dict(self.policy_net.state_dict())
+
     def optimize_model(self, memory):
-        if len(memory.memory) < args.BATCH_SIZE :
+        if len(memory) < args.BATCH_SIZE :
             return
-        transitions = memory.sample(args.BATCH_SIZE)
-#        print "transition ", transitions.size()
-        batch = Transition(*zip(*transitions))
-#        print "\ttransition \t", batch
-
-        non_final_mask = torch.tensor(
-                tuple(map(lambda s: s is not None, batch.next_state)), 
-                dtype=torch.uint8).to(self.device)
-        non_final_next_s_img = torch.cat([s[0] for s in batch.next_state if s is not None])
-        non_final_next_s_tuple = torch.cat([s[1] for s in batch.next_state if s is not None]).view(-1, 5)
-
-        s_img_batch = torch.cat([s[0] for s in batch.state])
-#        print "\t\t state_img ", s_img_batch
-        s_tuple_batch = torch.cat([s[1] for s in batch.state]).view(-1, 5)
-#        print "\t\t state_tuple", s_tuple_batch
-        a_batch = torch.cat(batch.action).view(args.BATCH_SIZE, -1)
-        r_batch = torch.cat(batch.reward)
-
-#        print "a_batch.size : ", a_batch.size()
-#        print "\ta_batch : ", a_batch
-
-        Q = self.policy_net(s_img_batch, s_tuple_batch)
+        with self.timer.phase('collate'):
+            if self.prefetcher is not None:
+                batch = self.prefetcher.get()
+            else:
+                with self.memory_lock:
+                    batch = memory.sample_batch(args.BATCH_SIZE, self.device)
+
+        with self.timer.phase('forward'):
+            Q = self.policy_net(batch.s_img, batch.s_tuple)
 #        print "QQQQQ ", Q.data.size()
 #        print "\tQ : ", Q
-        Q = Q.gather(1, a_batch)
+            Q = Q.gather(1, batch.action)
 #        print "\tQ_gather : ", Q
 
 #        s_img = state[0]
@@ -216,28 +359,91 @@ class LearningAgent(Agent):
 #        print "Q", Q
 #        Q = Q.index_select(dim=0, index=action)
 #        print "Q_ind", Q
-        V_next = torch.zeros(args.BATCH_SIZE, device=self.device)
-        V_next[non_final_mask] = self.target_net(
-                non_final_next_s_img, non_final_next_s_tuple
-                ).max(1)[0].detach()
-
-#        print_log("\treward : {}".format(r_batch), log)
-        expected_Q = (V_next * self.gamma) + r_batch
-
-        loss = F.smooth_l1_loss(Q, expected_Q.unsqueeze(1))
+            V_next = torch.zeros(args.BATCH_SIZE, device=self.device)
+            if len(batch.next_s_tuple) > 0:
+                V_next[batch.non_final_mask] = self.target_net(
+                        batch.next_s_img, batch.next_s_tuple
+                        ).max(1)[0].detach()
 
-        self.optimizer.zero_grad()
-        loss.backward()
-        for param in self.policy_net.parameters():
-            param.grad.data.clamp_(-1, 1)
-        self.optimizer.step()
+#        print_log("\treward : {}".format(batch.reward), log)
+            expected_Q = (V_next * self.gamma) + batch.reward
 
+            if batch.weight is None:
+                loss = F.smooth_l1_loss(Q, expected_Q.unsqueeze(1))
+            else:
+                # importance-sampling weighted loss; the TD errors become the new priorities
+                losses = F.smooth_l1_loss(Q, expected_Q.unsqueeze(1), reduction='none').view(-1)
+                loss = (batch.weight * losses).mean()
+                td_errors = (expected_Q.unsqueeze(1) - Q).detach().view(-1).cpu().numpy()
+
+        if batch.weight is not None:
+            with self.memory_lock:
+                memory.update_priorities(batch.index, td_errors)
+
+        with self.timer.phase('backward'):
+            self.optimizer.zero_grad()
+            loss.backward()
+            for param in self.policy_net.parameters():
+                param.grad.data.clamp_(-1, 1)
+            with self.weights_lock:
+                self.optimizer.step()
+        if not self.async_learner:
+            # acting_net is policy_net itself: a traced engine picks its
+            # weights up every broadcast_interval steps, not after each one
+            self.n_updates += 1
+            if self.n_updates % args.broadcast_interval == 0:
+                self.acting_version += 1
+
+
+    def checkpoint_state(self):
+        # CPU snapshot of everything training needs to pick up where it is now
+        from checkpoint import snapshot
+        with self.weights_lock:
+            checkpoint = snapshot({'policy_net': self.policy_net.state_dict(),
+                                   'target_net': self.target_net.state_dict(),
+                                   'optimizer': self.optimizer.state_dict()})
+        if args.checkpoint_replay:
+            with self.memory_lock:
+                checkpoint['memory'] = snapshot(self.memory.state_dict())
+        checkpoint['epsilon'] = self.epsilon
+        checkpoint['env_steps'] = self.env_steps
+        checkpoint['rng'] = {'random': random.getstate(), 'numpy': np.random.get_state(),
+                             'torch': torch.get_rng_state()}
+        return checkpoint
+
+    def load_checkpoint_state(self, checkpoint):
+        self.policy_net.load_state_dict(checkpoint['policy_net'])
+        self.target_net.load_state_dict(checkpoint['target_net'])
+        self.optimizer.load_state_dict(checkpoint['optimizer'])
+        if 'memory' in checkpoint:
+            self.memory.load_state_dict(checkpoint['memory'], device=self.device)
+        self.epsilon = checkpoint['epsilon']
+        self.env_steps = checkpoint['env_steps']
+        self.acting_version += 1
+        random.setstate(checkpoint['rng']['random'])
+        np.random.set_state(checkpoint['rng']['numpy'])
+        torch.set_rng_state(checkpoint['rng']['torch'])
+
+    def observe_screen(self, new_episode=False):
+        if self.pose_only:
+            return None
+        frame = self.env.get_screen().to(self.device)
+        if self.frame_stack is None:
+            return frame
+        if new_episode:
+            return self.frame_stack.reset(frame)
+        return self.frame_stack.push(frame)
 
     def update(self):
-        if self.state == None: # init
+        if self.state == None or self.env.get_steps() == 0: # init, or the first step of an episode
+            if not self.test:
+                with self.memory_lock:
+                    self.memory.start_episode()
+            if not self.pose_only:
+                self.env.update_screen()
             agent_pose = self.env.sense()
             self.state = state(
-                    state_img = self.env.get_screen().to(self.device),
+                    state_img = self.observe_screen(new_episode=True),
                     state_tuple = torch.Tensor(state_tuple(
                         x = agent_pose[0],
                         y = agent_pose[1],
@@ -253,14 +459,19 @@ class LearningAgent(Agent):
 
         self.env._image_show()
         # Select action according to your policy
-        action = self.get_action(self.state)
+        with self.timer.phase('get_action'):
+            action = self.get_action(self.state)
         # Execute action and get reward
-        next_agent_pose,reward = self.env.act(self, action)
+        with self.timer.phase('env_act'):
+            next_agent_pose,reward = self.env.act(self, action)
+        self.episode_return += reward
         # s_img update : screen plt update
-        self.env.update_screen()
+        if not self.pose_only:
+            with self.timer.phase('render'):
+                self.env.update_screen()
         
         self.next_state = state(
-                state_img = self.env.get_screen().to(self.device),
+                state_img = self.observe_screen(),
                 state_tuple = torch.Tensor(state_tuple(
                     x=next_agent_pose[0], 
                     y=next_agent_pose[1], 
@@ -272,24 +483,39 @@ class LearningAgent(Agent):
 
         # Learn policy based on state, action, reward
         if not self.test:
-            self.memory.push(
-                    self.state, 
-                    torch.LongTensor([car_sim_env.valid_actions.index(action)]).to(self.device), 
-                    self.next_state,
-                    torch.Tensor([reward]).to(self.device)
-                    )
-            self.optimize_model(self.memory)
+            with self.timer.phase('replay_push'), self.memory_lock:
+                self.memory.push(
+                        self.state, 
+                        torch.LongTensor([car_sim_env.valid_actions.index(action)]).to(self.device), 
+                        self.next_state,
+                        torch.Tensor([reward]).to(self.device)
+                        )
+            if self.async_learner:
+                self.env_steps += 1
+            else:
+                self.optimize_model(self.memory)
 
         self.state = self.next_state
     
+    def acting_q_values(self, s_img, s_tuple):
+        if self.engine is None:
+            return self.acting_net(s_img, s_tuple)
+        # read the version before the net, a swap in between only costs an extra refresh
+        version = self.acting_version
+        if version != self.engine_version:
+            self.engine.refresh(self.acting_net)
+            self.engine_version = version
+        return self.engine(s_img, s_tuple)
+
     def get_action(self, state): 
-        s_img = state[0].view(1,1,60,80)
+        s_img = frame_to_float(state[0]).view(1,-1,60,80) if state[0] is not None else None
         s_tuple = state[1].view(1,5)
         
         if random.random() > self.epsilon :
             with torch.no_grad():
-                q_values = self.policy_net(s_img, s_tuple)
-                print "\tq_values", q_values
+                q_values = self.acting_q_values(s_img, s_tuple)
+                if runlog.tracing():
+                    runlog.trace('q_values', q_values=q_values)
                 action_selected = car_sim_env.valid_actions[q_values.argmax(dim=1, keepdim=False)]
 #                print "\tget_action : act", (action_selected)
         else :
@@ -299,7 +525,13 @@ class LearningAgent(Agent):
 
 
 def run(restore):
-    env = car_sim_env()
+    if args.actors > 0:
+        # the workers act in their own headless environments
+        train_with_actors(LearningAgent(None, is_test=False), restore)
+        return
+    env = car_sim_env(render_backend=args.render_backend, obstacle_field=args.obstacle_field,
+                      field_resolution=args.field_resolution, field_conservative=not args.field_approximate,
+                      sprite_cache=args.sprite_cache)
     agt = LearningAgent(env, is_test=False)
     env.set_agent(agt, enforce_deadline=False)
 
@@ -314,10 +546,9 @@ def run(restore):
 
     env.plt_show()
     train(env, agt, restore)
-    while True:
-        continue
 
 def _replayMemoryImageCheck_forTest(agt, dir_idx) :
+    import torchvision.utils
     m = agt.memory
     DATA_DIR_CUR = './data/{}_replaymemory_cur'.format(dir_idx)
     DATA_DIR_NEXT = './data/{}_replaymemory_next'.format(dir_idx)
@@ -335,14 +566,19 @@ def _replayMemoryImageCheck_forTest(agt, dir_idx) :
             os.mkdir(DATA_DIR_NEXT)
 
         if 1 :
+            # copy the frames under the lock, the learner thread samples and updates m
+            with agt.memory_lock:
+                frames = [(frame_to_float(m[i].state.state_img),
+                           None if m[i].next_state is None else frame_to_float(m[i].next_state.state_img))
+                          for i in range(len(m))]
 #            x = []
-            for i in range(len(m.memory)):
-                x_c = m.memory[i].state.state_img
+            for i, (x_c, x_n) in enumerate(frames):
                 #x_t = m.memory[i][0][0]
                 save_path_cur = os.path.join(DATA_DIR_CUR, 'state{}.png'.format(i))
                 torchvision.utils.save_image(x_c, save_path_cur)
                 
-                x_n = m.memory[i].next_state.state_img
+                if x_n is None:
+                    continue
                 save_path_next = os.path.join(DATA_DIR_NEXT, 'state{}.png'.format(i))
                 torchvision.utils.save_image(x_n, save_path_next)
                 #x_t = T.functional.to_pil_image(x_t)
@@ -358,22 +594,202 @@ def _replayMemoryImageCheck_forTest(agt, dir_idx) :
     except OSError:
         print "mkdir failed: Creating a new dir failed."
 
+def schedule_epsilon(agt, trial):
+    if not agt.test:
+        if trial > 80000 and trial < 150000:
+            agt.epsilon = 0.3
+        elif trial > 150000 and trial < 250000:
+            agt.epsilon = 0.2
+        elif trial > 250000:
+            agt.epsilon =20000 / float(trial)  # changed to this when trial >= 2300000
+
+def print_rates(trial, succ_times, hit_wall_times, hit_car_times, num_hit_time_limit, num_out_of_time):
+    total_runs = succ_times + hit_wall_times + hit_car_times + num_hit_time_limit \
+                 + num_out_of_time
+    total_runs = max(total_runs, 1)
+    succ_rate = succ_times / float(total_runs)
+    hit_cars_rate = hit_car_times / float(total_runs)
+    hit_wall_rate = hit_wall_times / float(total_runs)
+    hit_hard_time_limit_rate = num_hit_time_limit  / float(total_runs)
+    out_of_time_rate = num_out_of_time / float(total_runs)
+
+    print_log('***********************************************************************', log)
+    print_log('n_episode:{}'.format(trial), log)
+    print_log('successful trials / total runs: {}/{}'.format(succ_times, total_runs), log)
+    print_log('number of trials that hit cars: {}'.format(hit_car_times), log)
+    print_log('number of trials that hit walls: {}'.format(hit_wall_times), log)
+    print_log('number of trials that hit the hard time limit: {}'.format(num_hit_time_limit), log)
+    print_log('number of trials that ran out of time: {}'.format(num_out_of_time), log)
+    print_log('successful rate: {}'.format(succ_rate), log)
+    print_log('hit cars rate: {}'.format(hit_cars_rate), log)
+    print_log('hit wall rate: {}'.format(hit_wall_rate), log)
+    print_log('hit hard time limit rate: {}'.format(hit_hard_time_limit_rate), log)
+    print_log('out of time rate: {}'.format(out_of_time_rate), log)
+    print_log('**********************************************************************', log)
+    runlog.info('interval', trial=trial, total_runs=total_runs, succ_rate=succ_rate, hit_cars_rate=hit_cars_rate,
+                hit_wall_rate=hit_wall_rate, hit_hard_time_limit_rate=hit_hard_time_limit_rate,
+                out_of_time_rate=out_of_time_rate)
+    log.flush()
+    runlog.flush()
+
+def print_sprite_stats(trial, sprites):
+    stats = sprites.stats()
+    print_log('sprite cache: {entries} sprites ({bytes} bytes), hit rate {hit_rate:.3f}, '
+              '{hits} hits, {misses} misses, {evictions} evictions'.format(**stats), log)
+    runlog.info('sprite_cache', trial=trial, **stats)
+
+def restore_training(agt, restore):
+    '''
+    Loads the latest checkpoint under CHECKPOINT_DIR into agt when restore
+    is set. Returns the last trial it covers and the env counters saved
+    with it, (0, {}) without one.
+    '''
+    from checkpoint import latest_checkpoint, load_checkpoint
+    path = latest_checkpoint(CHECKPOINT_DIR) if restore else None
+    if path is None:
+        return 0, {}
+    checkpoint = load_checkpoint(path)
+    agt.load_checkpoint_state(checkpoint)
+    print_log("Restored {} at trial {}".format(path, checkpoint['trial']), log)
+    return checkpoint['trial'], checkpoint['env_counters']
+
+def new_checkpoint_writer():
+    if args.checkpoint_interval <= 0:
+        return None
+    from checkpoint import CheckpointWriter
+    return CheckpointWriter(CHECKPOINT_DIR, keep=args.checkpoint_keep)
+
+def save_training(writer, env_counters, agt, trial):
+    # snapshot now, written by the background writer
+    if writer is None or trial % args.checkpoint_interval != 0:
+        return
+    agt.memory.flush()
+    checkpoint = agt.checkpoint_state()
+    checkpoint['trial'] = trial
+    checkpoint['env_counters'] = env_counters
+    writer.save(trial, checkpoint)
+
+def headless_env_kwargs():
+    # car_sim_env arguments of the environments run apart from the main one
+    return {'render_backend': 'numpy', 'obstacle_field': args.obstacle_field,
+            'field_resolution': args.field_resolution, 'field_conservative': not args.field_approximate,
+            'sprite_cache': args.sprite_cache}
+
+def new_evaluator():
+    # before any thread is started: the evaluation workers are forked
+    if args.eval_interval <= 0:
+        return None
+    from evaluate import Evaluator
+    return Evaluator(args.eval_workers, args.eval_episodes, seed=args.eval_seed,
+                     env_kwargs=headless_env_kwargs(), observation=args.observation,
+                     frame_stack=args.frame_stack)
+
+def evaluate_policy(evaluator, agt, trial):
+    # submits a greedy evaluation every eval_interval trials, logs the finished ones
+    if evaluator is None:
+        return
+    from evaluate import format_report
+    if trial % args.eval_interval == 0:
+        with agt.weights_lock:
+            evaluator.submit(agt.policy_net, trial)
+    for eval_trial, report in evaluator.poll():
+        lines = format_report(report)
+        print_log('Policy at trial {}, {}'.format(eval_trial, lines[0]), log)
+        for line in lines[1:]:
+            print_log(line, log)
+        runlog.info('evaluation', trial=eval_trial, **report)
+
+def train_with_actors(agt, restore):
+    '''
+    Learner side of the actor pool: args.actors worker processes act in
+    their own environments, the learner moves their transitions into its
+    replay memory, runs args.replay_ratio gradient steps per transition and
+    broadcasts the policy weights every args.broadcast_interval steps.
+    A trial is one episode finished by any worker.
+    '''
+    from actors import ActorPool, STAT_FIELDS
+    start_trial, restored = restore_training(agt, restore)
+    # the evaluation workers and the actors are forked before the writer thread starts
+    evaluator = new_evaluator()
+    pool = ActorPool(args.actors, agt.policy_net, env_kwargs=headless_env_kwargs(), ring_capacity=args.actor_ring_size)
+    pool.set_epsilon(agt.epsilon)
+    pool.start()
+    print_log("Started {} actor processes".format(args.actors), log)
+    writer = new_checkpoint_writer()
+    if args.prefetch > 0:
+        agt.start_prefetcher(args.prefetch)
+
+    trial = start_trial
+    n_updates = 0
+    update_credit = 0.0
+    reported = pool.episode_stats()
+    try:
+        while True:
+            with agt.timer.phase('actor_drain'), agt.memory_lock:
+                n_new = pool.drain(agt.memory)
+            if n_new == 0:
+                time.sleep(0.001)
+                continue
+
+            update_credit += n_new * args.replay_ratio
+            while update_credit >= 1.0:
+                agt.optimize_model(agt.memory)
+                update_credit -= 1.0
+                n_updates += 1
+                if n_updates % args.broadcast_interval == 0:
+                    pool.broadcast(agt.policy_net)
+
+            stats = pool.episode_stats()
+            while trial < start_trial + stats['episodes']:
+                trial += 1
+                schedule_epsilon(agt, trial)
+                agt.update_epsilon()
+                if trial % args.TARGET_UPDATE_CYCLE == 0 :
+                    with agt.timer.phase('target_sync'):
+                        agt.sync_target()
+
+                if trial % args.TEST_INTERVAL == 0:
+                    agt.memory.flush()
+                    print_rates(trial, *[stats[name] - reported[name] for name in STAT_FIELDS[1:]])
+                    reported = stats
+                save_training(writer, dict((name, restored.get(name, 0) + stats[name]) for name in STAT_FIELDS[1:]),
+                              agt, trial)
+                evaluate_policy(evaluator, agt, trial)
+                agt.timer.maybe_dump(trial)
+            pool.set_epsilon(agt.epsilon)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
+        if agt.prefetcher is not None:
+            agt.prefetcher.stop()
+        if writer is not None:
+            writer.close()
+        if evaluator is not None:
+            evaluator.close()
+        runlog.flush()
+
 def train(env, agt, restore):
+    from actors import STAT_FIELDS
+    from evaluate import outcome_counters, episode_outcome
     n_trials = 9999999999
     quit = False
-    max_index = 0
+    max_index, restored = restore_training(agt, restore)
+    for name, value in restored.items():
+        setattr(env, name, value)
+    evaluator = new_evaluator()  # forks: before the writer thread starts
+    writer = new_checkpoint_writer()
+    if args.prefetch > 0:
+        agt.start_prefetcher(args.prefetch)
+    if args.async_learner:
+        agt.start_learner_thread(args.replay_ratio, args.broadcast_interval)
     for trial in xrange(max_index + 1, n_trials):
         # time.sleep(3)
-        print "\tSimulator.run(): Trial {}".format(trial)  # [debug]
-        if not agt.test:
-            if trial > 80000 and trial < 150000:
-                agt.epsilon = 0.3
-            elif trial > 150000 and trial < 250000:
-                agt.epsilon = 0.2
-            elif trial > 250000:
-                agt.epsilon =20000 / float(trial)  # changed to this when trial >= 2300000
+        schedule_epsilon(agt, trial)
 
         env.reset()
+        counters = outcome_counters(env)
+        agt.episode_return = 0.0
 
         while True:
             try:
@@ -385,33 +801,21 @@ def train(env, agt, restore):
                 if env.done or quit:
                     agt.update_epsilon()
                     break
+        runlog.info('episode', trial=trial, outcome=episode_outcome(env, counters), steps=env.t,
+                    episode_return=agt.episode_return, epsilon=agt.epsilon)
         if trial % args.TARGET_UPDATE_CYCLE == 0 :
-            agt.target_net.load_state_dict(agt.policy_net.state_dict())
+            with agt.timer.phase('target_sync'):
+                agt.sync_target()
 
         if trial % args.TEST_INTERVAL == 0:
-            _replayMemoryImageCheck_forTest(agt, trial)
-
-            total_runs = env.succ_times + env.hit_wall_times + env.hit_car_times + env.num_hit_time_limit \
-                         + env.num_out_of_time
-            succ_rate = env.succ_times / float(total_runs)
-            hit_cars_rate = env.hit_car_times / float(total_runs)
-            hit_wall_rate = env.hit_wall_times / float(total_runs)
-            hit_hard_time_limit_rate = env.num_hit_time_limit  / float(total_runs)
-            out_of_time_rate = env.num_out_of_time / float(total_runs)
-            
-            print_log('***********************************************************************', log)
-            print_log('n_episode:{}'.format(trial), log)
-            print_log('successful trials / total runs: {}/{}'.format(env.succ_times, total_runs), log)
-            print_log('number of trials that hit cars: {}'.format(env.hit_car_times), log)
-            print_log('number of trials that hit walls: {}'.format(env.hit_wall_times), log)
-            print_log('number of trials that hit the hard time limit: {}'.format(env.num_hit_time_limit), log)
-            print_log('number of trials that ran out of time: {}'.format(env.num_out_of_time), log)
-            print_log('successful rate: {}'.format(succ_rate), log)
-            print_log('hit cars rate: {}'.format(hit_cars_rate), log)
-            print_log('hit wall rate: {}'.format(hit_wall_rate), log)
-            print_log('hit hard time limit rate: {}'.format(hit_hard_time_limit_rate), log)
-            print_log('out of time rate: {}'.format(out_of_time_rate), log)
-            print_log('**********************************************************************', log)
+            agt.memory.flush()
+            if not agt.pose_only:
+                _replayMemoryImageCheck_forTest(agt, trial)
+
+            print_rates(trial, env.succ_times, env.hit_wall_times, env.hit_car_times,
+                        env.num_hit_time_limit, env.num_out_of_time)
+            if env.sprites is not None:
+                print_sprite_stats(trial, env.sprites)
             '''
             if agt.test:
                 rates_file = os.path.join(data_path, 'rates' + '.cpickle')
@@ -429,6 +833,10 @@ def train(env, agt, restore):
             
             env.clear_count()
 
+        save_training(writer, dict((name, getattr(env, name)) for name in STAT_FIELDS[1:]), agt, trial)
+        evaluate_policy(evaluator, agt, trial)
+        agt.timer.maybe_dump(trial)
+
         '''
         if not agt.test:
             if trial % 2000 == 0:
@@ -441,8 +849,14 @@ def train(env, agt, restore):
                 break
         '''
 
+def main(argv=None, prog=None):
+    if prog:
+        parser.prog = prog
+    setup(argv)
+    run(restore = args.restore)
+
 if __name__ == '__main__':
-    run(restore = True)
+    main()
 
 
 
@@ -0,0 +1,269 @@
+# -----------------------------------
+# micro-benchmarks of the simulator and learner hot paths, with a JSON
+# baseline to compare against: a slower median beyond the tolerance fails
+# -----------------------------------
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure(fn, repeats=7, min_time=0.05):
+    '''
+    Per-call times of fn in microseconds: the call count of a block is
+    grown until a block lasts min_time, then repeats blocks are timed.
+    Returns the median, mean, std and min over the blocks.
+    '''
+    n_calls = 1
+    while True:
+        start = time.time()
+        for _ in range(n_calls):
+            fn()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        growth = 1.2 * min_time / elapsed if elapsed > 0 else 10.0
+        n_calls = max(n_calls + 1, int(n_calls * min(growth, 10.0)))
+    samples = np.empty(repeats)
+    for i in range(repeats):
+        start = time.time()
+        for _ in range(n_calls):
+            fn()
+        samples[i] = (time.time() - start) / n_calls * 1e6
+    return {'median_us': float(np.median(samples)), 'mean_us': float(samples.mean()),
+            'std_us': float(samples.std()), 'min_us': float(samples.min()), 'calls': n_calls}
+
+
+def env_benchmarks(backends=('numpy', 'matplotlib')):
+    from car_parking_env import car_sim_env
+    from car_parking_env import Agent
+    import tools
+
+    env = car_sim_env(render_backend='numpy')
+    env.set_agent(None, enforce_deadline=False)
+    env.reset()
+    agent = Agent()
+    agent.state = tools.state(None, torch.Tensor(env.sense()))
+    rng = random.Random(0)
+
+    def act():
+        if env.done:
+            env.reset()
+        action = rng.choice(car_sim_env.valid_actions)
+        pose, _ = env.act(agent, action)
+        agent.state = tools.state(None, torch.Tensor(pose))
+        env.step()
+
+    pose = env.generate_agent_pose()
+    yield 'env.act', act
+    yield 'env.agent_step', lambda: env.agent_step(pose.copy(), 'accel')
+    yield 'env.sense', env.sense
+
+    for backend in backends:
+        screen_env = env if backend == 'numpy' else car_sim_env(render_backend=backend)
+        screen_env.reset()
+        yield 'env.update_screen.' + backend, screen_env.update_screen
+
+    # incremental agent-only redraw against a full redraw of the layout
+    render_args = (env.agent_verts, env.get_head_pose(), env.agent_center)
+    yield 'renderer.render', lambda: env.renderer.render(*render_args)
+    yield 'renderer.render_full', lambda: env.renderer.render_full(*render_args)
+
+    # sprite cache hit: composite a cached agent mask
+    from renderer import SpriteCache, rgba_to_observation
+    sprites = SpriteCache(env.renderer, env.agent_shape)
+    yield 'renderer.sprite_cache', lambda: sprites.render(env.agent_pose)
+
+    # grayscale + downsample of a 640x480 matplotlib canvas
+    canvas = np.random.RandomState(0).randint(0, 256, (480, 640, 4)).astype(np.uint8)
+    yield 'renderer.rgba_to_observation', lambda: rgba_to_observation(canvas)
+
+
+def collision_benchmarks():
+    import tools
+    from car_parking_env import car_sim_env
+    env = car_sim_env(render_backend='numpy')
+    verts = env.get_rect_verts(env.agent_pose[:2], env.car_length, env.car_width, env.agent_pose[2])
+    yield 'tools.two_rects_intersect', lambda: tools.two_rects_intersect(verts, env.car1_verts)
+    yield 'tools.rects_intersect_batch', lambda: tools.rects_intersect_batch(verts[np.newaxis], env.car1_verts)
+    yield 'tools.sat_rects_intersect', lambda: tools.sat_rects_intersect(verts, env.car1_verts)
+    # the per-step wall test of car_sim_env.collide_walls
+    yield 'env.collide_walls', env.collide_walls
+
+
+def replay_benchmarks(batch_sizes=(32,)):
+    import tools
+    capacity = 10000
+    rng = np.random.RandomState(0)
+    # uint8 screens, as update_screen produces them
+    frames = [torch.from_numpy(rng.randint(0, 256, (1, 60, 80)).astype(np.uint8)) for _ in range(16)]
+
+    def transition(i):
+        next_state = None if i % 50 == 49 else tools.state(frames[(i + 1) % 16], torch.rand(5))
+        return (tools.state(frames[i % 16], torch.rand(5)), torch.LongTensor([i % 9]),
+                next_state, torch.Tensor([1.0]))
+
+    kinds = (('list', lambda: tools.ReplayMemory(capacity)),
+             ('array', lambda: tools.ArrayReplayMemory(capacity)),
+             ('dedup', lambda: tools.DedupReplayMemory(capacity)))
+    for kind, make in kinds:
+        memory = make()
+        for i in range(capacity):
+            memory.push(*transition(i))
+        counter = [0]
+
+        def push(memory=memory):
+            counter[0] += 1
+            memory.push(*transition(counter[0]))
+
+        yield 'replay.{}.push'.format(kind), push
+        for n in batch_sizes:
+            yield 'replay.{}.sample_batch.{}'.format(kind, n), \
+                lambda memory=memory, n=n: memory.sample_batch(n, 'cpu')
+
+
+def model_benchmarks(batch_sizes=(1, 32, 128)):
+    from model.model import DQN
+    from model.model import PoseDQN
+    for name, net in (('DQN', DQN(vec_size=5, n_actions=9)), ('PoseDQN', PoseDQN(vec_size=5, n_actions=9))):
+        net.eval()
+        for n in batch_sizes:
+            x_img = torch.rand(n, 1, 60, 80)
+            x_v = torch.rand(n, 5)
+
+            def forward(net=net, x_img=x_img, x_v=x_v):
+                with torch.no_grad():
+                    net(x_img, x_v)
+            yield '{}.forward.{}'.format(name, n), forward
+
+
+def learner_benchmarks(batch_sizes=(32, 128)):
+    import agent
+    import tools
+    save_path = tempfile.mkdtemp(prefix='bench_')
+    agent.setup(['--SAVE_PATH', save_path + '/', '--path', os.path.join(REPO_DIR, 'data/'),
+                 '--render_backend', 'numpy', '--checkpoint_interval', '0'])
+    from car_parking_env import car_sim_env
+
+    env = car_sim_env(render_backend='numpy')
+    agt = agent.LearningAgent(env)
+    rng = np.random.RandomState(0)
+    for i in range(max(batch_sizes) * 4):
+        img = torch.from_numpy(rng.rand(1, 60, 80).astype(np.float32))
+        agt.memory.push(tools.state(img, torch.rand(5)), torch.LongTensor([i % 9]),
+                        tools.state(img, torch.rand(5)), torch.Tensor([1.0]))
+    for n in batch_sizes:
+        def optimize(n=n):
+            agent.args.BATCH_SIZE = n
+            agt.optimize_model(agt.memory)
+        yield 'LearningAgent.optimize_model.{}'.format(n), optimize
+
+
+def startup_benchmarks():
+    # fresh interpreters, so each call pays the imports again
+    commands = (('import.car_parking_env', ['-c', 'import car_parking_env']),
+                ('import.agent', ['-c', 'import agent']),
+                ('rlpark.eval.help', ['rlpark.py', 'eval', '--help']),
+                ('rlpark.train.help', ['rlpark.py', 'train', '--help']))
+    with open(os.devnull, 'w') as devnull:
+        for name, command in commands:
+            def start(command=command):
+                subprocess.check_call([sys.executable] + command, cwd=REPO_DIR, stdout=devnull, stderr=devnull)
+            yield 'startup.' + name, start
+
+
+SUITES = (('env', env_benchmarks), ('collision', collision_benchmarks), ('replay', replay_benchmarks),
+          ('model', model_benchmarks), ('learner', learner_benchmarks), ('startup', startup_benchmarks))
+
+
+def run(suites=None, name_filter=None, repeats=7, min_time=0.05, log=sys.stdout):
+    '''
+    Runs the selected suites and returns {name: measure() result}. The
+    debug prints of the code under test go to /dev/null meanwhile (they are
+    still formatted and written, so they stay in the timings).
+    '''
+    results = {}
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for suite, benchmarks in SUITES:
+            if suites and suite not in suites:
+                continue
+            for name, fn in benchmarks():
+                if name_filter and name_filter not in name:
+                    continue
+                results[name] = r = measure(fn, repeats=repeats, min_time=min_time)
+                log.write('{:45s} {:12.1f} us  +- {:5.1f}%  (min {:.1f}, {} calls)\n'.format(
+                          name, r['median_us'], 100 * r['std_us'] / max(r['mean_us'], 1e-9), r['min_us'], r['calls']))
+                log.flush()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    '''
+    Names whose median is slower than the baseline median by more than
+    tolerance and by more than three baseline standard deviations, with
+    their time ratio.
+    '''
+    regressions = []
+    for name, r in sorted(results.items()):
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        limit = max(base['median_us'] * (1 + tolerance), base['median_us'] + 3 * base['std_us'])
+        if r['median_us'] > limit:
+            regressions.append((name, r['median_us'] / base['median_us']))
+    return regressions
+
+
+def environment_info():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'torch': torch.__version__,
+            'machine': platform.machine(), 'threads': torch.get_num_threads()}
+
+
+def main(argv=None, prog=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog=prog, description='micro-benchmarks of the simulator and learner hot paths')
+    parser.add_argument('--suite', default=None, nargs='+', choices=[name for name, _ in SUITES])
+    parser.add_argument('--filter', default=None, type=str, help='only the benchmarks whose name contains this')
+    parser.add_argument('--repeats', default=7, type=int, help='timed blocks per benchmark')
+    parser.add_argument('--min_time', default=0.05, type=float, help='seconds per timed block')
+    parser.add_argument('--baseline', default=None, type=str, help='JSON baseline to compare against')
+    parser.add_argument('--tolerance', default=0.25, type=float, help='allowed slowdown over the baseline median')
+    parser.add_argument('--save_baseline', default=None, type=str, help='write the results as a new baseline')
+    opts = parser.parse_args(argv)
+
+    torch.manual_seed(0)
+    np.random.seed(0)
+    random.seed(0)
+    results = run(opts.suite, opts.filter, opts.repeats, opts.min_time)
+
+    if opts.save_baseline:
+        with open(opts.save_baseline, 'w') as f:
+            json.dump({'environment': environment_info(), 'results': results}, f, indent=2, sort_keys=True)
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], opts.tolerance)
+        for name, ratio in regressions:
+            sys.stdout.write('REGRESSION {:45s} {:.2f}x the baseline median\n'.format(name, ratio))
+        if regressions:
+            sys.exit(1)
+        sys.stdout.write('no regression against {} ({} benchmarks compared)\n'.format(
+                         opts.baseline, len(set(results) & set(baseline['results']))))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,33 @@
-import matplotlib as mpl
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.path import Path
-from matplotlib import animation
-import matplotlib.patches as mpl_patches
 import math
 import random
 import sys, tty, termios
 import threading
-from matplotlib.ticker import MultipleLocator
 import tools
+import runlog
+from renderer import NumpyRenderer, SpriteCache, rgba_to_observation
+from obstacle_field import ObstacleField
 from datetime import datetime
 import time
 import re
 import os
-from PIL import Image
 import torch
-import torchvision
 
 
 DATA_DIR='data'
 
+# matplotlib is only needed by the 'matplotlib' render backend: it is
+# imported on first use, so that headless runs and their worker processes
+# start without it
+def _pyplot():
+    import matplotlib.pyplot as plt
+    return plt
+
+def _patches():
+    from matplotlib.path import Path
+    import matplotlib.patches as mpl_patches
+    return Path, mpl_patches
+
 class car_sim_env(object):
     valid_actions = ['accel','decel','left_D','right_D','left_R','right_R', 'keep', 'handle_left', 'handle_right'] 
     #, 'brake', 'brake_handle_left', 'brake_handle_right']
@@ -42,15 +49,16 @@ class car_sim_env(object):
 #                          valid_actions[10]: np.array([0.0, delta_angle]),\
 #                          valid_actions[11]: np.array([0.0, -delta_angle])
                           }
-    def __init__(self):
+    render_backends = ['matplotlib', 'numpy']
+
+    def __init__(self, render_backend='numpy', obstacle_field=False, field_resolution=0.05,
+                 field_conservative=True, sprite_cache=0):
         self.done = False
         self.enforce_deadline = False
+        # 'matplotlib' draws the figure a human can watch, 'numpy' rasterizes headless
+        assert render_backend in self.render_backends, render_backend
+        self.render_backend = render_backend
 
-        self.rect_codes = [Path.MOVETO,
-                           Path.LINETO,
-                           Path.LINETO,
-                           Path.LINETO,
-                           Path.CLOSEPOLY]
         # self.wall_verts = np.array([[-3.53, 4.0], [4.469, 4], [4.469, -4], [-3.53, -4], [-3.53, 4.0]])
         self.car_length = 4.800
         self.car_width = 1.830
@@ -79,24 +87,48 @@ class car_sim_env(object):
         self.car2_center = np.array([4.65, 0.0])
         self.car2_verts = self.get_rect_verts(self.car2_center, 5.7, 5, angle=0.0)
         self.car2_verts_closed = self.close_rect(self.car2_verts)
-
-        self.wall_path = Path(self.wall_verts_closed, self.rect_codes)
-        self.car1_path = Path(self.car1_verts_closed, self.rect_codes)
-        self.car2_path = Path(self.car2_verts_closed, self.rect_codes)
-
-        self.env_fig = plt.figure() # both env and car patches
-        '''
-        self.ax adds environment(transparent) and car to our plt.figure (self.env_fig)
-        '''
-        self.ax = self.env_fig.add_subplot(111, aspect='equal')
-        self.ax.axis('off')
-
-        self.wall_patch = mpl_patches.PathPatch(self.wall_path, edgecolor='blue', facecolor='white', lw=5)
-        self.car1_patch = mpl_patches.PathPatch(self.car1_path, facecolor='blue', lw=0)
-        self.car2_patch = mpl_patches.PathPatch(self.car2_path, facecolor='blue', lw=0)
-        self.ax.add_patch(self.wall_patch)
-        self.ax.add_patch(self.car1_patch)
-        self.ax.add_patch(self.car2_patch)
+        self.fixed_car_verts = np.stack((self.car1_verts, self.car2_verts))
+
+        # optional precomputed distance field for the static obstacles; in
+        # conservative mode, poses near an obstacle boundary use the exact tests
+        self.obstacle_field = None
+        self.field_conservative = field_conservative
+        if obstacle_field:
+            self.obstacle_field = ObstacleField(self.wall_verts, [self.car1_verts, self.car2_verts],
+                                                resolution=field_resolution,
+                                                cache_dir=os.path.join(DATA_DIR, 'field_cache'))
+
+        if self.render_backend == 'matplotlib':
+            plt = _pyplot()
+            Path, mpl_patches = _patches()
+            self.rect_codes = [Path.MOVETO,
+                               Path.LINETO,
+                               Path.LINETO,
+                               Path.LINETO,
+                               Path.CLOSEPOLY]
+            self.wall_path = Path(self.wall_verts_closed, self.rect_codes)
+            self.car1_path = Path(self.car1_verts_closed, self.rect_codes)
+            self.car2_path = Path(self.car2_verts_closed, self.rect_codes)
+
+            self.env_fig = plt.figure() # both env and car patches
+            '''
+            self.ax adds environment(transparent) and car to our plt.figure (self.env_fig)
+            '''
+            self.ax = self.env_fig.add_subplot(111, aspect='equal')
+            self.ax.axis('off')
+
+            self.wall_patch = mpl_patches.PathPatch(self.wall_path, edgecolor='blue', facecolor='white', lw=5)
+            self.car1_patch = mpl_patches.PathPatch(self.car1_path, facecolor='blue', lw=0)
+            self.car2_patch = mpl_patches.PathPatch(self.car2_path, facecolor='blue', lw=0)
+            self.ax.add_patch(self.wall_patch)
+            self.ax.add_patch(self.car1_patch)
+            self.ax.add_patch(self.car2_patch)
+        else:
+            self.renderer = NumpyRenderer(self.wall_verts, [self.car1_verts, self.car2_verts])
+        # optional LRU of agent sprites (numpy backend): the car is drawn at the quantized pose
+        self.sprites = None
+        if sprite_cache > 0 and self.render_backend == 'numpy':
+            self.sprites = SpriteCache(self.renderer, self.agent_shape, capacity=sprite_cache)
 
         self.position_noise = 0.008
         self.angle_noise = 0.008
@@ -116,9 +148,13 @@ class car_sim_env(object):
         self.t = 0
 
         self.init_agent() # Initialize agent parameters
-        self.ax.add_patch(self.agent_patch)
-        self.ax.add_patch(self.agent_head_patch)
-        self.ax.add_patch(self.agent_center_patch)
+        if self.render_backend == 'matplotlib':
+            # animated: left out of canvas.draw(), blitted over the cached background by update_screen
+            for patch in (self.agent_patch, self.agent_head_patch, self.agent_center_patch):
+                patch.set_animated(True)
+                self.ax.add_patch(patch)
+            self.fig_background = None
+            self.fig_background_key = None
 
         self.anim = [] # For keeping track of each FuncAnimation separately
         self.idx = 0 # index for state image frame
@@ -139,6 +175,8 @@ class car_sim_env(object):
 
     # Creates and shows parking environment
     def create_parking_env(self):
+        plt = _pyplot()
+        Path, mpl_patches = _patches()
         self.parking_fig = plt.figure() # Parking env patch only
         '''
         self.ax2 adds parking environment only to plt.figure (self.parking_fig)
@@ -160,20 +198,12 @@ class car_sim_env(object):
         self.ax2.add_patch(self.env_car1_patch)
         self.ax2.add_patch(self.env_car2_patch)
 
-    def img2data(self, fig):
-        '''
-        Convert image to a 4D numpy array with RGBA channels and return it
-        '''
-        fig.canvas.draw() # draw the renderer
-        w, h = fig.canvas.get_width_height()
-        buf = np.fromstring(fig.canvas.tostring_argb(), dtype=np.uint8)
-        buf.shape = (w, h, 4)
-
-        buf = np.roll(buf, 3, axis = 2)
-        #with open('img2data.txt', 'w') as f:
-        #    print >> f, 'img2data:', buf, '\n', '--------------------'
-        return buf
-    
+    def canvas_rgba(self):
+        # (H, W, 4) uint8 view of the Agg buffer of env_fig, no copy
+        renderer = self.env_fig.canvas.get_renderer()
+        rgba = np.frombuffer(self.env_fig.canvas.buffer_rgba(), dtype=np.uint8)
+        return rgba.reshape(int(renderer.height), int(renderer.width), 4)
+
     def captureStates(self):
         if False :
             try:
@@ -191,31 +221,11 @@ class car_sim_env(object):
 
         #self.lock.acquire()
         
-        downsample_size = 80, 60
-        ####
-        fig = self.env_fig
-        fig.canvas.draw() # draw the renderer
-        w, h = fig.canvas.get_width_height()
-        buf = np.fromstring(fig.canvas.tostring_argb(), dtype=np.uint8)
-        buf.shape = (w, h, 4)
-
-        buf = np.roll(buf, 3, axis = 2)
-        #with open('img2data.txt', 'w') as f:
-        #    print >> f, 'img2data:', buf, '\n', '--------------------'
-        img = buf
-        ####
-        #img = self.img2data(self.env_fig)
-        w, h, d = img.shape
-        img = Image.frombytes('L', (w, h), img.tostring() )
-        
-        #img = img.convert('L') # convert as grayscale
-        img.thumbnail(downsample_size, Image.ANTIALIAS)
-        img = np.array(img)
-        img = torch.from_numpy(img)
-        img = img.type('torch.FloatTensor')
-        img = img/255.
-        img = img.view(1, 60, 80)
-        print "\timg.size", img.size()
+        # canvas.draw() leaves out the animated agent patches
+        self.draw_agent_patches()
+        img = torch.from_numpy(rgba_to_observation(self.canvas_rgba())).view(1, 60, 80)
+        if runlog.tracing():
+            runlog.trace('capture_states', img_size=img.size())
         self.state_img = img
         #self.lock.release()
 
@@ -292,12 +302,12 @@ class car_sim_env(object):
         #if self.agent is not None:
         if True :
             if self.t >= self.hard_time_limit:
-                print "Environment.step(): Primary agent hit hard time limit! Trial aborted."
+                runlog.debug('trial_aborted', reason='hard_time_limit', t=self.t)
                 self.done = True
                 self.num_hit_time_limit += 1
 
             elif self.enforce_deadline and self.t >= self.deadline:
-                print "Environment.step(): Primary agent ran out of time! Trial aborted."
+                runlog.debug('trial_aborted', reason='deadline', t=self.t, deadline=self.deadline)
                 self.done = True
                 self.num_out_of_time += 1
 # -----------------------------------
@@ -413,7 +423,8 @@ class car_sim_env(object):
         prev_distance = self.distance # d(t-1)
         self.distance = math.sqrt((pose[0] - self.destination[0])**2 + (pose[1] - self.destination[1])**2)
         reward = (prev_distance - self.distance) * 5.0 # (d(t-1) - d(t)) * 5.0 = Reward
-        print("[ Distance: ", self.distance, ' ] : [ Distance reward: ', reward, ' ] ')
+        if runlog.tracing():
+            runlog.trace('distance', distance=self.distance, reward=reward)
 
         return reward
 
@@ -600,52 +611,25 @@ class car_sim_env(object):
         return self.t
 
     def collide_fixed_cars(self):
+        if self.obstacle_field is not None:
+            exact_test = None
+            if self.field_conservative:
+                exact_test = lambda idx: np.array([self.collide_fixed_cars_with_pose(self.agent_pose)])
+            return bool(self.obstacle_field.collide(self.agent_verts, 'cars', exact_test)[0])
+
         self.lock.acquire()
-        agent_center_to_car1_center = np.linalg.norm(self.agent_center - self.car1_center)
-        agent_center_to_car2_center = np.linalg.norm(self.agent_center - self.car2_center)
-        
-        car1_collision = False
-        car2_collision = False
-        #if agent_center_to_car1_center > self.car_diagonal_length:
-            # in this case, agent is not possible to collide with car1
-         #   car1_collision = False
-        #else:
-        car1_collision = tools.two_rects_intersect(self.agent_verts, self.car1_verts)
-
-       # if not car1_collision:
-        #    if agent_center_to_car2_center > self.car_diagonal_length:
-        #        car2_collision = False
-         #   else:
-        car2_collision = tools.two_rects_intersect(self.agent_verts, self.car2_verts)
+        # the agent's bounding circle has a radius of half its diagonal; the
+        # SAT kernel culls the parked cars that circle cannot reach
+        collision = tools.sat_rects_intersect(self.agent_verts, self.fixed_car_verts,
+                                              radius1=self.car_diagonal_length / 2).any()
         self.lock.release()
-        if car1_collision or car2_collision:
-            return True
-        else:
-            return False
+        return bool(collision)
 
     def collide_fixed_cars_with_pose(self, pose):
-        agent_center = pose[:2]
         verts = self.get_rect_verts(pose[:2], self.car_length, self.car_width, pose[2])
-        agent_center_to_car1_center = np.linalg.norm(agent_center - self.car1_center)
-        agent_center_to_car2_center = np.linalg.norm(agent_center - self.car2_center)
-        car1_collision = False
-        car2_collision = False
-        if agent_center_to_car1_center > self.car_diagonal_length:
-            # in this case, agent is not possible to collide with car1
-            car1_collision = False
-        else:
-            car1_collision = tools.two_rects_intersect(verts, self.car1_verts)
-
-        if not car1_collision:
-            if agent_center_to_car2_center > self.car_diagonal_length:
-                car2_collision = False
-            else:
-                car2_collision = tools.two_rects_intersect(verts, self.car2_verts)
-
-        if car1_collision or car2_collision:
-            return True
-        else:
-            return False
+        collision = tools.sat_rects_intersect(verts, self.fixed_car_verts,
+                                              radius1=self.car_diagonal_length / 2).any()
+        return bool(collision)
 
     def time_over(self):
         self.lock.acquire()
@@ -667,6 +651,12 @@ class car_sim_env(object):
             return False
 
     def collide_walls(self):
+        if self.obstacle_field is not None:
+            exact_test = None
+            if self.field_conservative:
+                exact_test = lambda idx: np.array([self.collide_walls_with_pose(self.agent_pose)])
+            return bool(self.obstacle_field.collide(self.agent_verts, 'wall', exact_test)[0])
+
         self.lock.acquire()
         # agent_center_to_wall_center = np.linalg.norm(self.agent_center - self.wall_center)
         # if agent_center_to_wall_center < self.wall_edge_length / 2.0 - self.car_length / 2:
@@ -683,7 +673,7 @@ class car_sim_env(object):
         #     self.lock.release()
         #     return wall_collision or out_of_wall
 
-        wall_collision = tools.two_rects_intersect(self.agent_verts, self.wall_verts)
+        wall_collision = tools.rects_intersect_batch(self.agent_verts[np.newaxis], self.wall_verts)[0]
         out_of_wall = False
         if self.agent_center[0] > self.wall_verts[0, 0] and self.agent_center[0] < self.wall_verts[1, 0] \
                 and self.agent_center[1] > self.wall_verts[2, 1] and self.agent_center[1] < self.wall_verts[1, 1]:
@@ -695,7 +685,7 @@ class car_sim_env(object):
 
     def collide_walls_with_pose(self, pose):
         verts = self.get_rect_verts(pose[:2], self.car_length, self.car_width, pose[2])
-        wall_collision = tools.two_rects_intersect(verts, self.wall_verts)
+        wall_collision = tools.rects_intersect_batch(verts[np.newaxis], self.wall_verts)[0]
         out_of_wall = False
         if pose[0] > self.wall_verts[0, 0] and pose[0] < self.wall_verts[1, 0] \
                 and pose[1] > self.wall_verts[2, 1] and pose[1] < self.wall_verts[1, 1]:
@@ -728,13 +718,7 @@ class car_sim_env(object):
             #print('start_x:', x, 'start_y:', y)
             theta = self.car_angle
             #theta = random.uniform(0, 2 * np.pi) #Generate random car_head angle
-            if x < self.car1_verts[1,0] and x > self.car2_verts[0,0] \
-                and y < self.car1_verts[0,1] and y > self.car1_verts[-1,1]:
-                continue
-
-            elif self.collide_fixed_cars_with_pose(np.array([x, y ,theta])):
-                continue
-            else:
+            if self.valid_start_pose(x, y, theta):
                 break
         cur_speed = 0.0 # current speed
         theta_steering = 0.0 # current steering angle
@@ -742,6 +726,29 @@ class car_sim_env(object):
         # return np.array([x, y, theta])
         return np.array([x,y,theta, cur_speed, theta_steering])
 
+    def valid_start_pose(self, x, y, theta):
+        # not in the slot between the parked cars, and clear of them
+        if x < self.car1_verts[1,0] and x > self.car2_verts[0,0] \
+            and y < self.car1_verts[0,1] and y > self.car1_verts[-1,1]:
+            return False
+        return not self.collide_fixed_cars_with_pose(np.array([x, y ,theta]))
+
+    def sample_start_poses(self, n_poses, seed=0):
+        '''
+        n_poses start poses drawn with a seeded RNG over agent_start_region,
+        any heading, and filtered like generate_agent_pose: the same seed
+        always gives the same set.
+        '''
+        rng = np.random.RandomState(seed)
+        poses = []
+        while len(poses) < n_poses:
+            x = rng.uniform(self.agent_start_region[0], self.agent_start_region[1])
+            y = rng.uniform(self.agent_start_region[2], self.agent_start_region[3])
+            theta = rng.uniform(0, 2 * np.pi)
+            if self.valid_start_pose(x, y, theta):
+                poses.append([x, y, theta, 0.0, 0.0])
+        return np.array(poses)
+
 
 
     def set_agent(self, agent, enforce_deadline=False):
@@ -752,68 +759,90 @@ class car_sim_env(object):
     def init_agent(self):
         self.starting_pose = self.generate_agent_pose()
         self.update_agent_pose(self.starting_pose)
-        delta_l = self.car_length / 2 * 3 / 5
-        delta_x = delta_l * np.cos(self.agent_pose[2])
-        delta_y = delta_l * np.sin(self.agent_pose[2])
-        head_pose = np.zeros(2)
-        head_pose[0] = self.agent_pose[0] + delta_x
-        head_pose[1] = self.agent_pose[1] + delta_y
+        if self.render_backend != 'matplotlib':
+            return
+        plt = _pyplot()
+        head_pose = self.get_head_pose()
         self.agent_head_patch = plt.Circle(head_pose, 0.03, color='black')
         self.agent_center_patch = plt.Circle(self.agent_center, 0.02, color='brown')
         self.agent_patch = plt.Polygon(self.agent_verts, facecolor='red', edgecolor='red')
 
 
-    # Update agent animation - the car agent is updated
-    def update_screen(self):
-        self.lock.acquire()
-        self.agent_patch.set_xy(self.agent_verts)
-
+    def get_head_pose(self):
         delta_l = self.car_length / 2 * 3 / 5
         delta_x = delta_l * np.cos(self.agent_dir)
         delta_y = delta_l * np.sin(self.agent_dir)
         head_pose = np.zeros(2)
         head_pose[0] = self.agent_center[0] + delta_x
         head_pose[1] = self.agent_center[1] + delta_y
+        return head_pose
+
+    def agent_shape(self, pose):
+        # what the renderers draw for a pose: the car polygon, the head and the centre points
+        center = np.asarray(pose[:2], dtype=np.float64)
+        delta_l = self.car_length / 2 * 3 / 5
+        head = center + delta_l * np.array([np.cos(pose[2]), np.sin(pose[2])])
+        return self.get_rect_verts(center, self.car_length, self.car_width, pose[2]), head, center
+
+    # Update agent animation - the car agent is updated
+    def update_screen(self):
+        '''
+        Renders the observation into state_img, a (1, 60, 80) uint8 tensor.
+        Consumers scale it to [0, 1] floats when they batch it
+        (tools.frame_to_float, tools.frames_to_tensor).
+        '''
+        if self.render_backend == 'numpy':
+            self.lock.acquire()
+            if self.sprites is not None:
+                img = self.sprites.render(self.agent_pose)
+            else:
+                img = self.renderer.render(self.agent_verts, self.get_head_pose(), self.agent_center)
+            # the renderer reuses its canvas: keep a copy
+            self.state_img = torch.from_numpy(img.copy()).view(1, 60, 80)
+            self.lock.release()
+            return
+
+        self.lock.acquire()
+        self.agent_patch.set_xy(self.agent_verts)
+
+        head_pose = self.get_head_pose()
         self.agent_head_patch.center = head_pose
         self.agent_center_patch.center = self.agent_center
-        
-        self.ax.add_patch(self.agent_patch)
-        self.ax.add_patch(self.agent_head_patch)
-        self.ax.add_patch(self.agent_center_patch)
-
-        ####
-        downsample_size = 60, 80
-        self.env_fig.canvas.draw()
-        _img = np.array(self.env_fig.canvas.renderer._renderer)
-        #print "\timg size0", _img.shape
-        _img = Image.fromarray(_img)
-        #print "\timg size1", _img.size
-        _img = torchvision.transforms.Grayscale()(_img)
-        #print "\timg size2", _img.size
-        _img = torchvision.transforms.Resize(downsample_size, interpolation=Image.BILINEAR)(_img)
-        #_img.save("./data/_tmp.png")
-        #print "\timg size3", _img.size
-        img = np.array(_img)
-        #print "\timg size4", img.size
-        img = torch.from_numpy(img)
-        #print "\timg size5", img.shape
-        img = img.type('torch.FloatTensor')
-        #print "\timg size6", img.shape
-        img = img/255.
-        #print "\timg size7", img.shape
-        img = img.view(1, 60, 80)
-        #print "\timg.size8", img.shape
-        #print "\timg", img
-        self.state_img = img
-        #torchvision.utils.save_image(img, './data/__tmp.png')
+        self.draw_agent_patches()
+
+        # grayscale + downsample straight from the Agg buffer
+        img = rgba_to_observation(self.canvas_rgba())
+        self.state_img = torch.from_numpy(img).view(1, 60, 80)
 
         self.lock.release()
+
+    def draw_agent_patches(self):
+        '''
+        Restores the cached static figure and draws the agent patches over
+        it, instead of redrawing the wall and the parked cars every step.
+        The background is redrawn when the figure size or the axis limits
+        change (plt_show() inverts both axes).
+        '''
+        canvas = self.env_fig.canvas
+        key = (canvas.get_width_height(), tuple(self.ax.get_xlim()), tuple(self.ax.get_ylim()))
+        if self.fig_background is None or key != self.fig_background_key:
+            canvas.draw()
+            self.fig_background = canvas.copy_from_bbox(self.env_fig.bbox)
+            self.fig_background_key = key
+        else:
+            canvas.restore_region(self.fig_background)
+        self.ax.draw_artist(self.agent_patch)
+        self.ax.draw_artist(self.agent_head_patch)
+        self.ax.draw_artist(self.agent_center_patch)
+        canvas.blit(self.env_fig.bbox)
+
 #    def create_agent(self, agent_class, *args, **kwargs):
 #        agent = agent_class(self, *args, **kwargs)
 #        return agent
 
     def _image_show(self):
-        plt.show()
+        if self.render_backend == 'matplotlib':
+            _pyplot().show()
 
     def get_rect_verts(self, center, length, width, angle):
         rotation_mtx = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
@@ -844,6 +873,9 @@ class car_sim_env(object):
         pass
 
     def plt_show(self):
+        if self.render_backend != 'matplotlib':
+            return
+        plt = _pyplot()
         self.create_parking_env() # Creates and shows parking environment
         #self.captureStates() # for init
         plt.close(self.parking_fig)
@@ -927,6 +959,256 @@ class Agent(object):
         return self.state
 
 
+class VecCarSimEnv(object):
+    '''
+    Steps n_envs cars at once. Every per-car quantity of car_sim_env lives in
+    an array with one row per environment: the (N, 5) pose
+    [x, y, theta_heading, speed, theta_steering], the distance used for the
+    distance reward, the stage/region flags and the step counter.
+    Finished environments are restarted automatically after each step, as
+    in gym's VecEnv.
+    '''
+    valid_actions = car_sim_env.valid_actions
+    action_table = np.array([car_sim_env.valid_actions_dict[a] for a in car_sim_env.valid_actions])
+
+    def __init__(self, n_envs, enforce_deadline=False, render=False, obstacle_field=False,
+                 field_resolution=0.05, field_conservative=True, sprite_cache=0):
+        self.n_envs = n_envs
+        self.enforce_deadline = enforce_deadline
+        self.render = render
+        # single env used for the static layout, the start poses, the screens
+        # and the optional obstacle field
+        self.template = car_sim_env(render_backend='numpy', obstacle_field=obstacle_field,
+                                    field_resolution=field_resolution, field_conservative=field_conservative,
+                                    sprite_cache=sprite_cache)
+        env = self.template
+
+        self.wall_verts = env.wall_verts
+        self.car1_verts = env.car1_verts
+        self.car2_verts = env.car2_verts
+        self.agent_local_verts = env.get_rect_verts(np.zeros(2), env.car_length, env.car_width, 0.0)
+        self.wheelbase = env.forward_radius * 2
+        self.max_steer_angle = env.max_steer_angle
+        self.angle_blockwidth = env.angle_blockwidth
+        self.hard_time_limit = env.hard_time_limit
+        self.destination = env.destination
+
+        self.poses = np.zeros((n_envs, 5))
+        self.starting_poses = np.zeros((n_envs, 5))
+        self.t = np.zeros(n_envs, dtype=np.int64)
+        self.deadline = np.zeros(n_envs, dtype=np.int64)
+        self.done = np.zeros(n_envs, dtype=bool)
+        self.has_finished_stage_two = np.zeros(n_envs, dtype=bool)
+        self.region_idx = np.ones(n_envs, dtype=np.int64)
+        self.to_terminal_idx = np.zeros(n_envs, dtype=np.int64)
+        # like car_sim_env, neither of these is cleared by reset()
+        self.r2z = np.zeros(n_envs, dtype=bool)
+        self.distance = np.full(n_envs, math.sqrt((env.car_x - self.destination[0]) ** 2 +
+                                                  (env.car_y - self.destination[1]) ** 2))
+        self.screens = np.empty((n_envs, 60, 80), dtype=np.uint8)
+
+        self.clear_count()
+        self.restart(np.ones(n_envs, dtype=bool))
+
+    def clear_count(self):
+        self.succ_times = 0
+        self.hit_wall_times = 0
+        self.hit_car_times = 0
+        self.num_hit_time_limit = 0
+        self.num_out_of_time = 0
+        self.time_over_times = 0
+
+    def reset(self):
+        '''Restarts every environment and returns their observation.'''
+        self.restart(np.ones(self.n_envs, dtype=bool))
+        return self.observe()
+
+    def restart(self, mask):
+        # new episodes for the masked environments; renders nothing
+        for i in np.flatnonzero(mask):
+            self.starting_poses[i] = self.template.generate_agent_pose()
+            self.deadline[i] = self.template.cal_deadline(self.starting_poses[i, 0], self.starting_poses[i, 1])
+        self.poses[mask] = self.starting_poses[mask]
+        self.done[mask] = False
+        self.t[mask] = 0
+        self.to_terminal_idx[mask] = 0
+        self.region_idx[mask] = 1
+        self.has_finished_stage_two[mask] = False
+
+    def observe(self):
+        '''Current observation of every environment, as a batched state.'''
+        screens = self.get_screens() if self.render else None
+        return tools.state(state_img=screens, state_tuple=self.poses.copy())
+
+    def get_screens(self, idx=None):
+        # screens of the environments in idx (all of them by default), as a copy
+        idx = np.arange(self.n_envs) if idx is None else idx
+        sprites = self.template.sprites
+        if sprites is not None:
+            for i in idx:
+                self.screens[i] = sprites.render(self.poses[i])
+            return self.screens[idx]
+        renderer = self.template.renderer
+        poses = self.poses[idx]
+        verts = self.agent_verts(poses)
+        delta_l = self.template.car_length / 2 * 3 / 5
+        heads = poses[:, :2] + delta_l * np.stack((np.cos(poses[:, 2]), np.sin(poses[:, 2])), axis=1)
+        for k, i in enumerate(idx):
+            self.screens[i] = renderer.render(verts[k], heads[k], poses[k, :2])
+        return self.screens[idx]
+
+    def agent_verts(self, poses):
+        # car_sim_env.get_rect_verts for every pose, as an (N, 4, 2) array
+        cos = np.cos(poses[:, 2])[:, np.newaxis]
+        sin = np.sin(poses[:, 2])[:, np.newaxis]
+        lx = self.agent_local_verts[:, 0][np.newaxis, :]
+        ly = self.agent_local_verts[:, 1][np.newaxis, :]
+        verts = np.empty((len(poses), 4, 2))
+        verts[:, :, 0] = cos * lx - sin * ly + poses[:, 0:1]
+        verts[:, :, 1] = sin * lx + cos * ly + poses[:, 1:2]
+        return verts
+
+    def agent_step(self, poses, actions):
+        speed = self.action_table[actions, 0]
+        delta_theta_steering = self.action_table[actions, 1]
+
+        new_poses = np.zeros_like(poses)
+        new_poses[:, 0] = poses[:, 0] + speed * np.cos(poses[:, 2])
+        new_poses[:, 1] = poses[:, 1] + speed * np.sin(poses[:, 2])
+        new_poses[:, 4] = np.minimum(poses[:, 4] + delta_theta_steering, self.max_steer_angle)
+        new_poses[:, 2] = (poses[:, 2] + (np.abs(speed) / self.wheelbase) * np.tan(new_poses[:, 4])) % (2 * np.pi)
+        return new_poses
+
+    def discretize_heading(self, theta):
+        idx = np.floor(theta / (self.angle_blockwidth / 2))
+        idx = np.where(idx % 2 == 0, idx / 2, (idx + 1) / 2)
+        return idx % 16
+
+    def sense(self):
+        '''
+        Batched car_sim_env.sense(): quantizes the poses to update the stage
+        and region flags, and returns a copy of the raw poses.
+        '''
+        env = self.template
+        poses = self.poses
+        b = env.stage_one_terminal_boundary
+        near = ((poses[:, 0] > b[0]) & (poses[:, 0] < b[1]) & (poses[:, 1] > b[2]) & (poses[:, 1] < b[3])) | \
+               self.has_finished_stage_two
+
+        fine = 0.1
+        coarse = 1.0
+        quantized = poses.copy()
+        quantized[:, :2] = np.where(near[:, np.newaxis],
+                                    np.floor((np.floor(poses[:, :2] / (fine / 2)) + 1) / 2) * fine,
+                                    np.floor(poses[:, :2] / coarse) * coarse + 0.55 * coarse)
+        quantized[:, 2] = self.discretize_heading(poses[:, 2])
+
+        reached, terminal_idx = self.reach_stage_two_terminal(quantized)
+        reached &= near
+        self.to_terminal_idx[reached] = terminal_idx[reached]
+        self.has_finished_stage_two |= reached
+        self.region_idx = np.where(near, np.where(self.has_finished_stage_two, 0, 1), 2)
+        return poses.copy()
+
+    def reach_stage_two_terminal(self, quantized):
+        bounds = self.template.stage_two_terminal_boundary
+        x, y, heading = quantized[:, 0], quantized[:, 1], quantized[:, 2]
+        in_x = (x[:, np.newaxis] >= bounds[:, 0]) & (x[:, np.newaxis] <= bounds[:, 1])
+        in_y = (y[:, np.newaxis] >= bounds[:, 2]) & (y[:, np.newaxis] <= bounds[:, 3])
+        # the first terminal box is open in y
+        in_y[:, 0] = (y > bounds[0, 2]) & (y < bounds[0, 3])
+        in_heading = heading[:, np.newaxis] == np.array([0, 8, 8, 0])
+        hit = in_x & in_y & in_heading
+        return hit.any(axis=1), hit.argmax(axis=1)
+
+    def collide_walls(self, verts):
+        field = self.template.obstacle_field
+        if field is not None:
+            exact_test = None
+            if self.template.field_conservative:
+                exact_test = lambda idx: self.collide_walls_exact(verts[idx], self.poses[idx, :2])
+            return field.collide(verts, 'wall', exact_test)
+        return self.collide_walls_exact(verts, self.poses[:, :2])
+
+    def collide_walls_exact(self, verts, center):
+        wall = self.wall_verts
+        inside = (center[:, 0] > wall[0, 0]) & (center[:, 0] < wall[1, 0]) & \
+                 (center[:, 1] > wall[2, 1]) & (center[:, 1] < wall[1, 1])
+        return tools.rects_intersect_batch(verts, wall) | ~inside
+
+    def collide_fixed_cars(self, verts):
+        field = self.template.obstacle_field
+        if field is not None:
+            exact_test = None
+            if self.template.field_conservative:
+                exact_test = lambda idx: self.collide_fixed_cars_exact(verts[idx])
+            return field.collide(verts, 'cars', exact_test)
+        return self.collide_fixed_cars_exact(verts)
+
+    def collide_fixed_cars_exact(self, verts):
+        return tools.sat_rects_intersect(verts, self.template.fixed_car_verts,
+                                         radius1=self.template.car_diagonal_length / 2).any(axis=1)
+
+    def step(self, actions):
+        '''
+        Applies one action index per environment.
+        Returns (next_state, rewards, dones, infos) like gym's VecEnv:
+        next_state holds the poses (and screens, when rendering) after the
+        finished environments were restarted, and infos[i]['terminal_observation']
+        the state environment i finished in.
+        '''
+        actions = np.asarray(actions, dtype=np.int64)
+        self.poses = self.agent_step(self.poses, actions)
+        poses = self.sense()
+        verts = self.agent_verts(poses)
+
+        prev_distance = self.distance
+        self.distance = np.hypot(poses[:, 0] - self.destination[0], poses[:, 1] - self.destination[1])
+        rewards = -1.0 + (prev_distance - self.distance) * 5.0
+
+        hit_wall = self.collide_walls(verts)
+        hit_car = ~hit_wall & self.collide_fixed_cars(verts)
+        undecided = ~(hit_wall | hit_car)
+        time_over = undecided & (self.t > 30) & (np.abs(poses[:, 0] - self.starting_poses[:, 0]) < 0.05)
+        undecided &= ~time_over
+        zone = undecided & (poses[:, 0] > 0.0) & (poses[:, 1] > -0.5) & ~self.r2z
+        undecided &= ~zone
+        b = self.template.terminal_boundary
+        terminal = undecided & (poses[:, 0] > b[0]) & (poses[:, 0] < b[1]) & (poses[:, 1] > b[2]) & (poses[:, 1] < b[3])
+
+        rewards[hit_wall | hit_car] = -100.0
+        rewards[time_over] = -10.0
+        rewards[zone] = 50.0
+        rewards[terminal] = 10000.0
+        self.r2z |= zone
+        self.done |= hit_wall | hit_car | time_over | terminal
+
+        self.hit_wall_times += int(hit_wall.sum())
+        self.hit_car_times += int(hit_car.sum())
+        self.time_over_times += int(time_over.sum())
+        self.succ_times += int(terminal.sum())
+
+        # car_sim_env.step(): time limits, then advance the clock of running envs
+        running = ~self.done
+        hit_time_limit = running & (self.t >= self.hard_time_limit)
+        out_of_time = running & ~hit_time_limit & self.enforce_deadline & (self.t >= self.deadline)
+        self.done |= hit_time_limit | out_of_time
+        self.num_hit_time_limit += int(hit_time_limit.sum())
+        self.num_out_of_time += int(out_of_time.sum())
+        self.t[running] += 1
+
+        dones = self.done.copy()
+        infos = [{} for _ in range(self.n_envs)]
+        if dones.any():
+            done_idx = np.flatnonzero(dones)
+            screens = self.get_screens(done_idx) if self.render else None
+            for k, i in enumerate(done_idx):
+                infos[i]['terminal_observation'] = tools.state(
+                    state_img=screens[k] if screens is not None else None, state_tuple=self.poses[i].copy())
+            self.restart(dones)
+        return self.observe(), rewards, dones, infos
+
+
 if __name__ == '__main__':
     print '============'
     car_sim = car_sim_env()
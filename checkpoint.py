@@ -0,0 +1,124 @@
+# -----------------------------------
+# training checkpoints: snapshots are taken on the training thread and
+# written to disk by a background thread, atomically (temp file + rename)
+# -----------------------------------
+import os
+import re
+import threading
+
+import numpy as np
+import torch
+
+CHECKPOINT_PATTERN = re.compile(r'^checkpoint_(\d+)\.pt$')
+
+
+def snapshot(obj):
+    '''
+    Detached CPU copy of a nested structure of tensors and arrays
+    (state_dicts, replay arrays), safe to write while training goes on.
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, np.ndarray):
+        return np.array(obj)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, tuple) and hasattr(obj, '_fields'):
+        # namedtuples (Transition, state) of the list replay memory
+        return type(obj)(*[snapshot(v) for v in obj])
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def checkpoint_path(directory, trial):
+    return os.path.join(directory, 'checkpoint_{:010d}.pt'.format(trial))
+
+
+def list_checkpoints(directory):
+    # checkpoint paths in directory, oldest trial first
+    if not os.path.isdir(directory):
+        return []
+    found = []
+    for name in os.listdir(directory):
+        match = CHECKPOINT_PATTERN.match(name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(directory, name)))
+    return [path for _, path in sorted(found)]
+
+
+def latest_checkpoint(directory):
+    checkpoints = list_checkpoints(directory)
+    return checkpoints[-1] if checkpoints else None
+
+
+def load_checkpoint(path):
+    return torch.load(path, map_location='cpu')
+
+
+class CheckpointWriter(object):
+    '''
+    Writes checkpoints on a background thread. save() only hands the
+    snapshot over: if the writer is still busy, a newer snapshot replaces
+    the pending one. Each file is written under a temporary name, synced
+    and renamed into place, so a checkpoint on disk is always complete;
+    only the newest keep checkpoints are kept.
+    '''
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.pending = None
+        self.condition = threading.Condition()
+        self.busy = False
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='checkpoint_writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, trial, state):
+        with self.condition:
+            self.pending = (trial, state)
+            self.condition.notify_all()
+
+    def wait(self):
+        # blocks until every saved snapshot is on disk
+        with self.condition:
+            while self.pending is not None or self.busy:
+                self.condition.wait()
+
+    def close(self):
+        self.wait()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                trial, state = self.pending
+                self.pending = None
+                self.busy = True
+            try:
+                self.write(trial, state)
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    def write(self, trial, state):
+        path = checkpoint_path(self.directory, trial)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+        for old_path in list_checkpoints(self.directory)[:-self.keep]:
+            os.remove(old_path)
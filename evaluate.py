@@ -0,0 +1,184 @@
+# -----------------------------------
+# greedy evaluation of a frozen policy copy in a process pool, over a
+# fixed seeded set of start poses, apart from the training episodes
+# -----------------------------------
+import multiprocessing as mp
+
+import numpy as np
+import torch
+
+from car_parking_env import car_sim_env
+from car_parking_env import Agent
+from model.model import build_net
+import tools
+import runlog
+
+# episode outcomes, matched to the car_sim_env counter each one bumps
+OUTCOMES = (('success', 'succ_times'), ('hit_car', 'hit_car_times'), ('hit_wall', 'hit_wall_times'),
+            ('time_over', 'time_over_times'), ('time_limit', 'num_hit_time_limit'),
+            ('out_of_time', 'num_out_of_time'))
+LENGTH_PERCENTILES = (50, 90, 99)
+
+# per-process state of the pool workers
+_worker = {}
+
+
+def _init_worker(env_kwargs, enforce_deadline, observation, frame_stack):
+    torch.set_num_threads(1)
+    runlog.configure()
+    env = car_sim_env(**env_kwargs)
+    env.set_agent(None, enforce_deadline=enforce_deadline)
+    net = build_net(observation, vec_size=5, n_actions=9, frame_stack=frame_stack)
+    net.eval()
+    _worker['env'] = env
+    _worker['net'] = net
+    _worker['observation'] = observation
+    _worker['frame_stack'] = frame_stack
+
+
+def outcome_counters(env):
+    return [getattr(env, counter) for _, counter in OUTCOMES]
+
+
+def episode_outcome(env, counters):
+    # name of the outcome whose counter moved since outcome_counters()
+    for (outcome, counter), before in zip(OUTCOMES, counters):
+        if getattr(env, counter) != before:
+            return outcome
+    return 'unknown'
+
+
+def run_episode(env, net, start_pose, observation='image', frame_stack=1):
+    '''
+    One greedy episode from start_pose, stepped like train() steps the
+    learning agent. Returns the outcome name and the number of steps.
+    With observation 'pose' nothing is rendered.
+    '''
+    stack = tools.FrameStack(frame_stack) if frame_stack > 1 else None
+
+    def screen(new_episode=False):
+        if observation == 'pose':
+            return None
+        env.update_screen()
+        if stack is None:
+            return env.get_screen()
+        return stack.reset(env.get_screen()) if new_episode else stack.push(env.get_screen())
+
+    env.starting_pose = np.array(start_pose, dtype=np.float64)
+    env.reset(repeat=True)
+    counters = outcome_counters(env)
+    agent = Agent()
+    agent.state = tools.state(screen(new_episode=True), torch.Tensor(env.sense()))
+    n_steps = 0
+    while not env.done:
+        s_img = agent.state.state_img
+        with torch.no_grad():
+            q_values = net(tools.frame_to_float(s_img).view(1, -1, 60, 80) if s_img is not None else None,
+                           agent.state.state_tuple.view(1, 5))
+        action = car_sim_env.valid_actions[int(q_values.argmax(dim=1))]
+        next_pose, _ = env.act(agent, action)
+        agent.state = tools.state(screen(), torch.Tensor(next_pose))
+        env.step()
+        n_steps += 1
+    return episode_outcome(env, counters), n_steps
+
+
+def _evaluate_poses(task):
+    weights, poses = task
+    net = _worker['net']
+    net.load_state_dict(dict((name, torch.from_numpy(w)) for name, w in weights.items()))
+    return [run_episode(_worker['env'], net, pose, _worker['observation'], _worker['frame_stack']) for pose in poses]
+
+
+def summarize(results):
+    '''
+    Rates of each outcome and percentiles of the episode lengths, over all
+    episodes and over the successful ones, from (outcome, length) pairs.
+    '''
+    outcomes = [outcome for outcome, _ in results]
+    lengths = np.array([length for _, length in results])
+    succ_lengths = np.array([length for outcome, length in results if outcome == 'success'])
+    report = {'episodes': len(results)}
+    for outcome, _ in OUTCOMES:
+        report[outcome + '_rate'] = outcomes.count(outcome) / float(max(len(results), 1))
+    for p in LENGTH_PERCENTILES:
+        report['length_p{}'.format(p)] = float(np.percentile(lengths, p)) if len(lengths) else None
+        report['success_length_p{}'.format(p)] = float(np.percentile(succ_lengths, p)) if len(succ_lengths) else None
+    return report
+
+
+class Evaluator(object):
+    '''
+    Pool of n_workers processes, each with its own headless environment,
+    that evaluates the policy greedily from the start poses drawn by
+    car_sim_env.sample_start_poses(n_episodes, seed). submit() snapshots the
+    weights and returns at once; poll() hands back the finished reports
+    as (tag, report) pairs, so the learner never waits on an evaluation.
+    observation and frame_stack select the network and its inputs, as in
+    agent.py. Build it before starting any thread: the workers are forked.
+    '''
+    def __init__(self, n_workers, n_episodes, seed=0, env_kwargs=None, enforce_deadline=False,
+                 observation='image', frame_stack=1):
+        env_kwargs = dict(env_kwargs or {})
+        env_kwargs['render_backend'] = 'numpy'
+        self.n_workers = n_workers
+        self.start_poses = car_sim_env(**env_kwargs).sample_start_poses(n_episodes, seed)
+        self.pool = mp.Pool(n_workers, initializer=_init_worker,
+                            initargs=(env_kwargs, enforce_deadline, observation, frame_stack))
+        self.pending = []
+
+    def submit(self, net, tag=None):
+        weights = dict((name, t.detach().cpu().numpy().copy()) for name, t in net.state_dict().items())
+        chunks = np.array_split(self.start_poses, self.n_workers)
+        tasks = [(weights, chunk) for chunk in chunks if len(chunk)]
+        self.pending.append((tag, self.pool.map_async(_evaluate_poses, tasks)))
+
+    def poll(self, wait=False):
+        finished = []
+        for tag, result in list(self.pending):
+            if wait or result.ready():
+                self.pending.remove((tag, result))
+                finished.append((tag, summarize([r for chunk in result.get() for r in chunk])))
+        return finished
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+def format_report(report):
+    lines = ['greedy evaluation over {} start poses:'.format(report['episodes'])]
+    lines.append('  ' + ', '.join('{}: {:.3f}'.format(outcome, report[outcome + '_rate']) for outcome, _ in OUTCOMES))
+    for prefix, name in (('length', 'episode length'), ('success_length', 'successful episode length')):
+        values = [report['{}_p{}'.format(prefix, p)] for p in LENGTH_PERCENTILES]
+        if values[0] is not None:
+            lines.append('  {} '.format(name) + ', '.join('p{}: {:.0f}'.format(p, v) for p, v in zip(LENGTH_PERCENTILES, values)))
+    return lines
+
+
+def main(argv=None, prog=None):
+    import argparse
+    from checkpoint import load_checkpoint
+    parser = argparse.ArgumentParser(prog=prog, description='greedy evaluation of a saved policy')
+    parser.add_argument('--checkpoint', required=True, type=str, help='training checkpoint (SAVE_PATH/checkpoints/...)')
+    parser.add_argument('--episodes', default=100, type=int)
+    parser.add_argument('--workers', default=2, type=int)
+    parser.add_argument('--seed', default=0, type=int, help='seed of the start poses')
+    parser.add_argument('--observation', default='image', choices=['image', 'pose'], help='observation mode the policy was trained with')
+    parser.add_argument('--frame_stack', default=1, type=int, help='frames per observation the policy was trained with')
+    parser.add_argument('--sprite_cache', default=0, type=int, help='--sprite_cache the policy was trained with')
+    opts = parser.parse_args(argv)
+
+    net = build_net(opts.observation, vec_size=5, n_actions=9, frame_stack=opts.frame_stack)
+    net.load_state_dict(load_checkpoint(opts.checkpoint)['policy_net'])
+    evaluator = Evaluator(opts.workers, opts.episodes, seed=opts.seed, env_kwargs={'sprite_cache': opts.sprite_cache},
+                          observation=opts.observation, frame_stack=opts.frame_stack)
+    evaluator.submit(net)
+    for _, report in evaluator.poll(wait=True):
+        for line in format_report(report):
+            print(line)
+    evaluator.close()
+
+
+if __name__ == '__main__':
+    main()
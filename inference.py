@@ -0,0 +1,117 @@
+# -----------------------------------
+# low-latency inference for acting: a traced, frozen copy of the DQN
+# fed from preallocated input buffers, and a latency benchmark
+# -----------------------------------
+import copy
+import time
+
+import numpy as np
+import torch
+
+from model.model import DQN
+
+IMG_SHAPE = (1, 60, 80)
+VEC_SIZE = 5
+
+
+class InferenceEngine(object):
+    '''
+    TorchScript trace of a frozen copy of a DQN, for forward passes only.
+    Every size in batch_sizes gets its own preallocated input buffers; a
+    call copies the inputs into the smallest buffer that fits and runs the
+    trace on that fixed shape, padding rows included. Larger calls run the
+    trace on the inputs directly. refresh(net) copies new weights into the
+    trace in place, without tracing again.
+    num_threads, when given, sets torch's intra-op thread count, which is
+    process-wide. img_shape is the shape of one observation, (k, 60, 80)
+    for stacks of k frames.
+    '''
+    def __init__(self, net, batch_sizes=(1,), device='cpu', num_threads=None, img_shape=IMG_SHAPE):
+        self.device = torch.device(device)
+        self.img_shape = tuple(img_shape)
+        self.batch_sizes = sorted(batch_sizes)
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        frozen = copy.deepcopy(net).to(self.device).eval()
+        for p in frozen.parameters():
+            p.requires_grad_(False)
+        self.inputs = dict((n, (torch.zeros((n,) + self.img_shape, device=self.device),
+                                torch.zeros(n, VEC_SIZE, device=self.device)))
+                           for n in self.batch_sizes)
+        with torch.no_grad():
+            self.module = torch.jit.trace(frozen, self.inputs[self.batch_sizes[-1]])
+        self.weights = self.module.state_dict()
+
+    def refresh(self, net):
+        with torch.no_grad():
+            for name, value in net.state_dict().items():
+                self.weights[name].copy_(value)
+
+    def __call__(self, x_img, x_v):
+        x_img = x_img.view((-1,) + self.img_shape)
+        x_v = x_v.view(-1, VEC_SIZE)
+        n = x_img.size(0)
+        with torch.no_grad():
+            for size in self.batch_sizes:
+                if size >= n:
+                    img, v = self.inputs[size]
+                    img[:n].copy_(x_img)
+                    v[:n].copy_(x_v)
+                    return self.module(img, v)[:n]
+            return self.module(x_img.to(self.device), x_v.to(self.device))
+
+
+def call_latency(fn, x_img, x_v, n_iters):
+    # per-call wall times in microseconds, after a few warm-up calls
+    for _ in range(10):
+        fn(x_img, x_v)
+    times = np.empty(n_iters)
+    for i in range(n_iters):
+        start = time.time()
+        fn(x_img, x_v)
+        times[i] = time.time() - start
+    return times * 1e6
+
+
+def benchmark(net=None, batch_sizes=(1, 32), n_iters=500, num_threads=None):
+    '''
+    Latency of the eager DQN against the InferenceEngine at each batch size.
+    Returns {batch_size: {'eager': (median, p90), 'engine': (median, p90)}}
+    in microseconds per call.
+    '''
+    net = net or DQN(vec_size=VEC_SIZE, n_actions=9)
+    net.eval()
+    engine = InferenceEngine(net, batch_sizes=batch_sizes, num_threads=num_threads)
+
+    def eager(x_img, x_v):
+        with torch.no_grad():
+            return net(x_img, x_v)
+
+    results = {}
+    for n in batch_sizes:
+        x_img = torch.rand((n,) + IMG_SHAPE)
+        x_v = torch.rand(n, VEC_SIZE)
+        if not torch.allclose(eager(x_img, x_v), engine(x_img, x_v), atol=1e-5):
+            raise RuntimeError('engine output differs from the eager DQN at batch size {}'.format(n))
+        results[n] = {}
+        for name, fn in (('eager', eager), ('engine', engine)):
+            times = call_latency(fn, x_img, x_v, n_iters)
+            results[n][name] = (np.percentile(times, 50), np.percentile(times, 90))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='DQN inference latency')
+    parser.add_argument('--batch_sizes', default=[1, 32], type=int, nargs='+')
+    parser.add_argument('--iters', default=500, type=int)
+    parser.add_argument('--threads', default=None, type=int, help='intra-op threads')
+    opts = parser.parse_args()
+
+    results = benchmark(batch_sizes=opts.batch_sizes, n_iters=opts.iters, num_threads=opts.threads)
+    print('threads: {}'.format(torch.get_num_threads()))
+    for n in opts.batch_sizes:
+        eager, engine = results[n]['eager'], results[n]['engine']
+        print('batch {:4d}  eager {:9.1f} us (p90 {:9.1f})  engine {:9.1f} us (p90 {:9.1f})'.format(
+              n, eager[0], eager[1], engine[0], engine[1]))
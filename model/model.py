@@ -4,12 +4,13 @@ import torch.nn.functional as F
 import random
 
 class DQN(nn.Module):
-    def __init__(self, vec_size, n_actions):
+    def __init__(self, vec_size, n_actions, in_channels=1):
         super(DQN, self).__init__()
-        # image_size = 80*60*4
+        # image_size = 80*60*in_channels (stacked frames)
+        self.in_channels = in_channels
 
         self.conv_img = nn.Sequential(
-                nn.Conv2d(1, 32, kernel_size=8, stride=4, padding=2), # 20*15
+                nn.Conv2d(in_channels, 32, kernel_size=8, stride=4, padding=2), # 20*15
                 nn.ReLU(inplace=True),
                 nn.Conv2d(32, 64, 3, 1, 1), # 20*15
                 nn.ReLU(inplace=True),
@@ -34,7 +35,7 @@ class DQN(nn.Module):
                 )
 
     def forward(self, x_img, x_v):
-        x_img = x_img.view(-1,1,60,80)
+        x_img = x_img.view(-1,self.in_channels,60,80)
 #        print "x_img size", x_img.size()
         img = self.conv_img(x_img)
         img = img.view(img.size(0), -1)
@@ -47,6 +48,32 @@ class DQN(nn.Module):
         out = self.fc_out(out)
         return out # actions
 
+class PoseDQN(nn.Module):
+    '''
+    Compact MLP on the pose vector alone, for the pose-only observation
+    mode. forward() takes the same (x_img, x_v) arguments as DQN and
+    ignores x_img, which is None in that mode.
+    '''
+    def __init__(self, vec_size, n_actions, hidden=128):
+        super(PoseDQN, self).__init__()
+
+        self.fc = nn.Sequential(
+                nn.Linear(vec_size, hidden),
+                nn.ReLU(inplace=True),
+                nn.Linear(hidden, hidden),
+                nn.ReLU(inplace=True),
+                nn.Linear(hidden, n_actions)
+                )
+
+    def forward(self, x_img, x_v):
+        return self.fc(x_v) # actions
+
+def build_net(observation, vec_size=5, n_actions=9, frame_stack=1):
+    # the network that matches an observation mode: 'image' (frame_stack frames) or 'pose'
+    if observation == 'pose':
+        return PoseDQN(vec_size, n_actions)
+    return DQN(vec_size, n_actions, in_channels=frame_stack)
+
 '''
 class DQN(nn.Module):
     def __init__(self, vec_size, n_actions):
@@ -0,0 +1,126 @@
+# -----------------------------------
+# torch-free inference of a trained DQN: the weights go to a flat .npz
+# and conv_img / fc_img / fc_v / fc_out run in plain NumPy
+# -----------------------------------
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+IMG_SHAPE = (1, 60, 80)
+VEC_SIZE = 5
+
+# (layer, stride, padding) of the convolutions in DQN.conv_img, each followed by a ReLU
+CONV_LAYERS = [('conv_img.0', 4, 2), ('conv_img.2', 1, 1), ('conv_img.4', 5, 0)]
+
+
+def export_npz(net, path):
+    # DQN state_dict -> .npz of float32 arrays, keyed like the state_dict
+    weights = dict((name, t.detach().cpu().numpy().astype(np.float32))
+                   for name, t in net.state_dict().items())
+    np.savez(path, **weights)
+
+
+def conv2d(x, weight, bias, stride, padding):
+    '''
+    (N, C, H, W) x (OC, C, KH, KW) cross-correlation, like torch's Conv2d:
+    the input windows are gathered from a strided view (im2col) and
+    multiplied with the flattened kernels in one matrix product.
+    '''
+    if padding:
+        x = np.pad(x, ((0, 0), (0, 0), (padding, padding), (padding, padding)), mode='constant')
+    n, c, h, w = x.shape
+    _, _, kh, kw = weight.shape
+    out_h = (h - kh) // stride + 1
+    out_w = (w - kw) // stride + 1
+    sn, sc, sh, sw = x.strides
+    # (N, OH, OW, C, KH, KW): each window is one contiguous row after the reshape
+    windows = as_strided(x, shape=(n, out_h, out_w, c, kh, kw),
+                         strides=(sn, sh * stride, sw * stride, sc, sh, sw))
+    cols = windows.reshape(n * out_h * out_w, c * kh * kw)
+    out = np.dot(cols, weight.reshape(len(weight), -1).T)
+    out += bias
+    return out.reshape(n, out_h, out_w, -1).transpose(0, 3, 1, 2)
+
+
+def linear(x, weight, bias):
+    return np.dot(x, weight.T) + bias
+
+
+def relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+class NumpyDQN(object):
+    '''
+    DQN.forward on the weights written by export_npz, for batches of
+    (N, 60, 80) frames in [0, 1] and (N, 5) poses.
+    '''
+    def __init__(self, weights):
+        self.weights = dict((name, np.ascontiguousarray(w, dtype=np.float32)) for name, w in weights.items())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(dict(f.items()))
+
+    def __call__(self, x_img, x_v):
+        w = self.weights
+        img = np.asarray(x_img, dtype=np.float32).reshape((-1,) + IMG_SHAPE)
+        for name, stride, padding in CONV_LAYERS:
+            img = relu(conv2d(img, w[name + '.weight'], w[name + '.bias'], stride, padding))
+        img = np.ascontiguousarray(img).reshape(len(img), -1)
+        img = relu(linear(img, w['fc_img.0.weight'], w['fc_img.0.bias']))
+
+        v = np.asarray(x_v, dtype=np.float32).reshape(-1, VEC_SIZE)
+        v = relu(linear(v, w['fc_v.0.weight'], w['fc_v.0.bias']))
+        v = relu(linear(v, w['fc_v.2.weight'], w['fc_v.2.bias']))
+
+        return linear(img + v, w['fc_out.0.weight'], w['fc_out.0.bias'])
+
+    def act(self, x_img, x_v):
+        # greedy action indices into car_sim_env.valid_actions
+        return self(x_img, x_v).argmax(axis=1)
+
+
+def _numpyDQNCheck_forTest(net=None, batch_size=64, seed=0):
+    '''
+    Largest absolute difference between the Q values of NumpyDQN and of the
+    torch DQN it was exported from, on random frames and poses.
+    '''
+    import torch
+    from model.model import DQN
+    net = net or DQN(vec_size=VEC_SIZE, n_actions=9)
+    net.eval()
+    rng = np.random.RandomState(seed)
+    x_img = rng.rand(batch_size, *IMG_SHAPE[1:]).astype(np.float32)
+    x_v = rng.uniform(-5, 5, (batch_size, VEC_SIZE)).astype(np.float32)
+    with torch.no_grad():
+        q_torch = net(torch.from_numpy(x_img), torch.from_numpy(x_v)).numpy()
+    weights = dict((name, t.numpy()) for name, t in net.state_dict().items())
+    q_numpy = NumpyDQN(weights)(x_img, x_v)
+    return float(np.abs(q_torch - q_numpy).max())
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    import time
+    parser = argparse.ArgumentParser(description='torch-free DQN inference')
+    parser.add_argument('--weights', default=None, type=str, help='.npz written by export_npz')
+    parser.add_argument('--export', default=None, type=str, help='torch state_dict to convert into --weights')
+    parser.add_argument('--check', action='store_true', help='compare against torch on random inputs')
+    opts = parser.parse_args()
+
+    if opts.export:
+        import torch
+        from model.model import DQN
+        net = DQN(vec_size=VEC_SIZE, n_actions=9)
+        net.load_state_dict(torch.load(opts.export, map_location='cpu'))
+        export_npz(net, opts.weights)
+    if opts.weights:
+        start = time.time()
+        policy = NumpyDQN.load(opts.weights)
+        q = policy(np.zeros((1,) + IMG_SHAPE[1:]), np.zeros((1, VEC_SIZE)))
+        print('loaded and ran in {:.1f} ms, torch imported: {}'.format(
+              (time.time() - start) * 1e3, 'torch' in sys.modules))
+    if opts.check:
+        print('max |Q_numpy - Q_torch|: {:.3g}'.format(_numpyDQNCheck_forTest()))
@@ -0,0 +1,165 @@
+# -----------------------------------
+# precomputed signed-distance field of the static obstacles
+# (outside of the wall, parked cars) for O(1) collision queries
+# -----------------------------------
+import os
+import hashlib
+import numpy as np
+
+# query results
+FREE = 0
+COLLIDE = 1
+UNDECIDED = -1
+
+
+def polygon_signed_distance(points, verts):
+    '''
+    Signed distance of (..., 2) points to a convex polygon,
+    negative inside and positive outside.
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    n = len(verts)
+    dist = np.full(points.shape[:-1], np.inf)
+    inside_dist = np.full(points.shape[:-1], np.inf)
+    area = 0.0
+    for i in range(n):
+        area += verts[i][0] * verts[(i + 1) % n][1] - verts[(i + 1) % n][0] * verts[i][1]
+    orientation = 1.0 if area >= 0 else -1.0
+    for i in range(n):
+        p1 = verts[i]
+        p2 = verts[(i + 1) % n]
+        edge = p2 - p1
+        rel = points - p1
+        t = np.clip((rel[..., 0] * edge[0] + rel[..., 1] * edge[1]) / np.dot(edge, edge), 0.0, 1.0)
+        closest = p1 + t[..., np.newaxis] * edge
+        dist = np.minimum(dist, np.linalg.norm(points - closest, axis=-1))
+        # distance to the edge line, positive on the inner side
+        line = orientation * (edge[0] * rel[..., 1] - edge[1] * rel[..., 0]) / np.linalg.norm(edge)
+        inside_dist = np.minimum(inside_dist, line)
+    return np.where(inside_dist > 0, -dist, dist)
+
+
+class ObstacleField(object):
+    '''
+    Grid of signed distances to the static obstacles, split in two layers:
+    'wall' (the area outside the wall rectangle) and 'cars' (the parked
+    cars). Distances are positive in free space.
+
+    A rectangle is tested by covering it with n_disks disks along its long
+    axis: it is free when every disk fits in free space, and colliding when
+    one of its corners or disk centres lies inside an obstacle. Both
+    decisions account for the grid's nearest-node error, so any rectangle
+    close to an obstacle boundary is left UNDECIDED.
+    '''
+    layers = ['wall', 'cars']
+
+    def __init__(self, wall_verts, car_verts_list, resolution=0.05, pad=5.0, n_disks=5, cache_dir=None):
+        self.wall_verts = np.asarray(wall_verts, dtype=np.float64)
+        self.car_verts_list = [np.asarray(v, dtype=np.float64) for v in car_verts_list]
+        self.resolution = resolution
+        self.pad = pad
+        self.n_disks = n_disks
+        # the field is 1-Lipschitz, so the nearest node is off by at most half a cell diagonal
+        self.error = resolution * np.sqrt(2) / 2
+
+        self.origin = self.wall_verts.min(axis=0) - pad
+        extent = self.wall_verts.max(axis=0) + pad - self.origin
+        self.shape = tuple(int(np.ceil(e / resolution)) + 1 for e in extent)
+
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, 'obstacle_field_{}.npz'.format(self.layout_key()))
+        if cache_path is not None and os.path.isfile(cache_path):
+            self.field = np.load(cache_path)['field']
+        else:
+            self.field = self.compute()
+            if cache_path is not None:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                np.savez(cache_path, field=self.field)
+
+    def layout_key(self):
+        # identifies the geometry and grid the field was computed for
+        h = hashlib.sha1()
+        for verts in [self.wall_verts] + self.car_verts_list:
+            h.update(np.round(verts, 6).tobytes())
+        h.update(np.array([self.resolution, self.pad]).tobytes())
+        return h.hexdigest()[:16]
+
+    def compute(self):
+        xs = self.origin[0] + np.arange(self.shape[0]) * self.resolution
+        ys = self.origin[1] + np.arange(self.shape[1]) * self.resolution
+        points = np.stack(np.meshgrid(xs, ys, indexing='ij'), axis=-1)
+        field = np.empty((len(self.layers),) + self.shape, dtype=np.float32)
+        # outside of the wall is the obstacle: flip the sign of the wall's own distance
+        field[0] = -polygon_signed_distance(points, self.wall_verts)
+        cars = [polygon_signed_distance(points, verts) for verts in self.car_verts_list]
+        field[1] = np.min(cars, axis=0)
+        return field
+
+    def sample(self, points, layer):
+        # nearest-node lookup, clamped to the grid
+        idx = np.rint((np.asarray(points) - self.origin) / self.resolution).astype(np.int64)
+        ix = np.clip(idx[..., 0], 0, self.shape[0] - 1)
+        iy = np.clip(idx[..., 1], 0, self.shape[1] - 1)
+        return self.field[self.layers.index(layer), ix, iy]
+
+    def footprint(self, verts):
+        '''
+        Disk cover of (N, 4, 2) rects ordered like car_sim_env.get_rect_verts:
+        returns the (N, n_disks, 2) disk centres and the (N,) disk radius.
+        '''
+        rear = (verts[:, 0] + verts[:, 3]) / 2
+        front = (verts[:, 1] + verts[:, 2]) / 2
+        frac = (np.arange(self.n_disks) + 0.5) / self.n_disks
+        centers = rear[:, np.newaxis, :] + frac[np.newaxis, :, np.newaxis] * (front - rear)[:, np.newaxis, :]
+        half_step = np.linalg.norm(front - rear, axis=1) / (2 * self.n_disks)
+        half_width = np.linalg.norm(verts[:, 0] - verts[:, 3], axis=1) / 2
+        return centers, np.hypot(half_step, half_width)
+
+    def outline(self, verts):
+        # (N, P, 2) points along the edges of (N, 4, 2) rects
+        edge_len = np.linalg.norm(np.roll(verts, -1, axis=1) - verts, axis=2).max()
+        n_points = int(np.ceil(edge_len / (2 * self.resolution)))
+        frac = np.arange(n_points) / float(n_points)
+        start = verts[:, :, np.newaxis, :]
+        edge = (np.roll(verts, -1, axis=1) - verts)[:, :, np.newaxis, :]
+        points = start + frac[np.newaxis, np.newaxis, :, np.newaxis] * edge
+        return points.reshape(len(verts), -1, 2)
+
+    def classify(self, verts, layer):
+        '''
+        Classifies (N, 4, 2) rects against one layer.
+        Returns an (N,) int8 array of FREE, COLLIDE or UNDECIDED.
+        '''
+        verts = np.asarray(verts, dtype=np.float64).reshape(-1, 4, 2)
+        centers, radius = self.footprint(verts)
+        disk_dist = self.sample(centers, layer)
+        inner_dist = np.concatenate((disk_dist, self.sample(verts, layer)), axis=1)
+
+        result = np.full(len(verts), UNDECIDED, dtype=np.int8)
+        result[(disk_dist - self.error > radius[:, np.newaxis]).all(axis=1)] = FREE
+        result[(inner_dist + self.error < 0).any(axis=1)] = COLLIDE
+        return result
+
+    def collide(self, verts, layer, exact_test=None):
+        '''
+        (N,) bool collision flags for (N, 4, 2) rects against one layer.
+        UNDECIDED rects are resolved by exact_test(idx) -> bool array, called
+        with the indices of the undecided rects, when given (conservative
+        mode); otherwise by the sign of the sampled distances along their
+        outline, spaced two grid cells apart, and at their disk centres.
+        '''
+        verts = np.asarray(verts, dtype=np.float64).reshape(-1, 4, 2)
+        result = self.classify(verts, layer)
+        undecided = result == UNDECIDED
+        collision = result == COLLIDE
+        if undecided.any():
+            if exact_test is not None:
+                collision[undecided] = exact_test(np.flatnonzero(undecided))
+            else:
+                v = verts[undecided]
+                centers, _ = self.footprint(v)
+                points = np.concatenate((centers, self.outline(v)), axis=1)
+                collision[undecided] = (self.sample(points, layer) < 0).any(axis=1)
+        return collision
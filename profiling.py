@@ -0,0 +1,150 @@
+# -----------------------------------
+# low-overhead per-phase timing of the training loop: streaming
+# histograms dumped as CSV rows and a Prometheus text file
+# -----------------------------------
+import bisect
+import os
+import time
+
+# bucket upper bounds in seconds: quarter powers of two from ~1 us to ~16 s
+BUCKET_BOUNDS = [2.0 ** (k / 4.0) for k in range(-80, 17)]
+
+
+class StreamingHistogram(object):
+    '''
+    Counts of observed durations in fixed log-spaced buckets, plus their
+    count, sum, min and max. Memory does not grow with the observations;
+    quantiles are read off the buckets.
+    '''
+    def __init__(self, bounds=BUCKET_BOUNDS):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        # interpolated geometrically inside the bucket holding the q-quantile
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            if n == 0 or cumulative + n < rank:
+                cumulative += n
+                continue
+            lower = max(self.bounds[i - 1] if i > 0 else self.min, self.min)
+            upper = min(self.bounds[i] if i < len(self.bounds) else self.max, self.max)
+            frac = (rank - cumulative) / float(n)
+            return lower * (upper / lower) ** frac if lower > 0 else upper * frac
+        return self.max
+
+
+class _Phase(object):
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start)
+
+
+class _NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class PhaseTimer(object):
+    '''
+    with timer.phase('render'): ... adds the time spent in the block to the
+    'render' histogram. A disabled timer hands out a shared no-op context.
+    A phase's context is reused, so one phase must not be timed from two
+    threads at once. dump() appends a row per phase to csv_path and
+    rewrites prom_path through a temporary file, so a scraper never reads
+    half of it.
+    '''
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, enabled=False, csv_path=None, prom_path=None, dump_interval=60.0):
+        self.enabled = enabled
+        self.csv_path = csv_path
+        self.prom_path = prom_path
+        self.dump_interval = dump_interval
+        self.histograms = {}
+        self.contexts = {}
+        self.last_dump = time.time()
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        context = self.contexts.get(name)
+        if context is None:
+            self.histograms[name] = StreamingHistogram()
+            context = self.contexts[name] = _Phase(self.histograms[name])
+        return context
+
+    def maybe_dump(self, trial):
+        if self.enabled and time.time() - self.last_dump >= self.dump_interval:
+            self.dump(trial)
+
+    def dump(self, trial):
+        self.last_dump = time.time()
+        if self.csv_path:
+            self.write_csv(trial)
+        if self.prom_path:
+            self.write_prometheus()
+
+    def write_csv(self, trial):
+        new_file = not os.path.isfile(self.csv_path)
+        with open(self.csv_path, 'a') as f:
+            if new_file:
+                f.write('time,trial,phase,count,total_s,mean_us,min_us,{},max_us\n'.format(
+                        ','.join('p{}_us'.format(int(q * 100)) for q in self.quantiles)))
+            for name in sorted(self.histograms):
+                h = self.histograms[name]
+                if h.count == 0:
+                    continue
+                row = [int(self.last_dump), trial, name, h.count, '{:.6f}'.format(h.sum),
+                       '{:.1f}'.format(h.sum / h.count * 1e6), '{:.1f}'.format(h.min * 1e6)]
+                row += ['{:.1f}'.format(h.quantile(q) * 1e6) for q in self.quantiles]
+                row.append('{:.1f}'.format(h.max * 1e6))
+                f.write(','.join(str(v) for v in row) + '\n')
+
+    def write_prometheus(self):
+        lines = ['# HELP rlpark_phase_seconds Time spent in each phase of the training loop.',
+                 '# TYPE rlpark_phase_seconds histogram']
+        for name in sorted(self.histograms):
+            h = self.histograms[name]
+            cumulative = 0
+            for bound, n in zip(h.bounds + ['+Inf'], h.counts):
+                cumulative += n
+                le = bound if bound == '+Inf' else repr(bound)
+                lines.append('rlpark_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(name, le, cumulative))
+            lines.append('rlpark_phase_seconds_sum{{phase="{}"}} {!r}'.format(name, h.sum))
+            lines.append('rlpark_phase_seconds_count{{phase="{}"}} {}'.format(name, h.count))
+        tmp_path = self.prom_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, self.prom_path)
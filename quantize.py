@@ -0,0 +1,172 @@
+# -----------------------------------
+# int8 export of the policy net for CPU-only deployment: post-training
+# static or dynamic quantization calibrated on replay frames, with a
+# greedy-action agreement, latency and size report against the fp32 net
+# -----------------------------------
+import copy
+import io
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.quantization import QuantStub, DeQuantStub
+
+from model.model import DQN
+from inference import IMG_SHAPE, VEC_SIZE, call_latency
+
+# conv/linear + relu pairs of DQN fused before quantization
+FUSE_GROUPS = [['conv_img.0', 'conv_img.1'], ['conv_img.2', 'conv_img.3'], ['conv_img.4', 'conv_img.5'],
+               ['fc_img.0', 'fc_img.1'], ['fc_v.0', 'fc_v.1'], ['fc_v.2', 'fc_v.3']]
+
+
+class QuantizableDQN(nn.Module):
+    '''
+    DQN.forward with quantize/dequantize stubs around it and a quantized
+    add for the sum of the image and pose branches. Takes over the layers
+    of a copy of net.
+    '''
+    def __init__(self, net):
+        super(QuantizableDQN, self).__init__()
+        net = copy.deepcopy(net).cpu().eval()
+        self.quant_img = QuantStub()
+        self.quant_v = QuantStub()
+        self.dequant = DeQuantStub()
+        self.conv_img = net.conv_img
+        self.fc_img = net.fc_img
+        self.fc_v = net.fc_v
+        self.fc_out = net.fc_out
+        self.add = nn.quantized.FloatFunctional()
+
+    def forward(self, x_img, x_v):
+        img = self.conv_img(self.quant_img(x_img.view((-1,) + IMG_SHAPE)))
+        img = img.reshape(img.size(0), -1)
+        img = self.fc_img(img)
+        v = self.fc_v(self.quant_v(x_v.view(-1, VEC_SIZE)))
+        out = self.fc_out(self.add.add(img, v))
+        return self.dequant(out)
+
+
+def replay_batches(memory, n_batches, batch_size):
+    # (s_img, s_tuple) CPU batches drawn from a replay memory
+    batches = []
+    for _ in range(n_batches):
+        batch = memory.sample_batch(batch_size, 'cpu')
+        batches.append((batch.s_img, batch.s_tuple))
+    return batches
+
+
+def quantize_static(net, calibration, backend='fbgemm'):
+    '''
+    Post-training static quantization: int8 weights and activations, with
+    the activation ranges observed on the calibration batches.
+    '''
+    torch.backends.quantized.engine = backend
+    model = QuantizableDQN(net)
+    model.eval()
+    torch.quantization.fuse_modules(model, FUSE_GROUPS, inplace=True)
+    model.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(model, inplace=True)
+    with torch.no_grad():
+        for x_img, x_v in calibration:
+            model(x_img, x_v)
+    torch.quantization.convert(model, inplace=True)
+    return model
+
+
+def quantize_dynamic(net):
+    # int8 weights for the linear layers, activations quantized on the fly; convs stay fp32
+    model = copy.deepcopy(net).cpu().eval()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def model_bytes(module):
+    f = io.BytesIO()
+    torch.save(module.state_dict(), f)
+    return len(f.getvalue())
+
+
+def compare(fp32_net, int8_net, batches, latency_batch_sizes=(1, 32), n_iters=200):
+    '''
+    Greedy-action agreement and largest Q-value error of int8_net against
+    fp32_net on the batches, latency (median microseconds per call) of both
+    at each of latency_batch_sizes, and the size of their state_dicts.
+    '''
+    fp32_net = copy.deepcopy(fp32_net).cpu().eval()
+    n_agree = 0
+    n_total = 0
+    max_error = 0.0
+    with torch.no_grad():
+        for x_img, x_v in batches:
+            q_fp32 = fp32_net(x_img, x_v)
+            q_int8 = int8_net(x_img, x_v)
+            n_agree += int((q_fp32.argmax(dim=1) == q_int8.argmax(dim=1)).sum())
+            n_total += len(q_fp32)
+            max_error = max(max_error, float((q_fp32 - q_int8).abs().max()))
+
+    report = {'agreement': n_agree / float(n_total), 'n_states': n_total, 'max_q_error': max_error,
+              'fp32_bytes': model_bytes(fp32_net), 'int8_bytes': model_bytes(int8_net),
+              'fp32_latency_us': {}, 'int8_latency_us': {}}
+    x_img = torch.cat([b[0] for b in batches]).view((-1,) + IMG_SHAPE)
+    x_v = torch.cat([b[1] for b in batches]).view(-1, VEC_SIZE)
+    for n in latency_batch_sizes:
+        for name, net in (('fp32', fp32_net), ('int8', int8_net)):
+            def forward(img, v):
+                with torch.no_grad():
+                    return net(img, v)
+            times = call_latency(forward, x_img[:n], x_v[:n], n_iters)
+            report[name + '_latency_us'][n] = float(np.median(times))
+    return report
+
+
+def export(net, memory, path, mode='static', n_calibration=32, n_eval=32, batch_size=64):
+    '''
+    Quantizes net, saves it as a TorchScript module at path and its report
+    (see compare) next to it as JSON. Calibration and evaluation use
+    separate batches drawn from memory. Returns the report.
+    '''
+    if mode == 'static':
+        int8_net = quantize_static(net, replay_batches(memory, n_calibration, batch_size))
+    else:
+        int8_net = quantize_dynamic(net)
+    report = compare(net, int8_net, replay_batches(memory, n_eval, batch_size))
+    report['mode'] = mode
+
+    example = (torch.zeros((1,) + IMG_SHAPE), torch.zeros(1, VEC_SIZE))
+    with torch.no_grad():
+        torch.jit.trace(int8_net, example).save(path)
+    report['exported_bytes'] = os.path.getsize(path)
+    with open(os.path.splitext(path)[0] + '_report.json', 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+    from tools import MmapReplayMemory
+
+    parser = argparse.ArgumentParser(description='int8 export of a trained policy net')
+    parser.add_argument('--weights', required=True, type=str, help='policy net state_dict saved with torch.save')
+    parser.add_argument('--replay_dir', required=True, type=str, help='mmap replay memory to calibrate on (SAVE_PATH/replay)')
+    parser.add_argument('--out', default='policy_int8.pt', type=str, help='TorchScript output path')
+    parser.add_argument('--mode', default='static', choices=['static', 'dynamic'])
+    parser.add_argument('--calibration_batches', default=32, type=int)
+    parser.add_argument('--eval_batches', default=32, type=int)
+    opts = parser.parse_args()
+
+    with open(os.path.join(opts.replay_dir, 'layout.json')) as f:
+        layout = json.load(f)
+    memory = MmapReplayMemory(layout['capacity'], opts.replay_dir, layout['img_shape'], layout['vec_size'])
+    net = DQN(vec_size=VEC_SIZE, n_actions=9)
+    net.load_state_dict(torch.load(opts.weights, map_location='cpu'))
+
+    report = export(net, memory, opts.out, mode=opts.mode,
+                    n_calibration=opts.calibration_batches, n_eval=opts.eval_batches)
+    print('greedy-action agreement: {:.4f} over {} states (max |dQ| {:.4f})'.format(
+          report['agreement'], report['n_states'], report['max_q_error']))
+    print('size: fp32 {} bytes, int8 {} bytes ({} as TorchScript)'.format(
+          report['fp32_bytes'], report['int8_bytes'], report['exported_bytes']))
+    for n in sorted(report['fp32_latency_us']):
+        print('batch {:4d} latency: fp32 {:9.1f} us, int8 {:9.1f} us'.format(
+              n, report['fp32_latency_us'][n], report['int8_latency_us'][n]))
@@ -0,0 +1,309 @@
+# -----------------------------------
+# headless NumPy rasterizer for the parking scene
+# draws the wall, the parked cars and the agent straight into a
+# (60, 80) uint8 grayscale array, without going through matplotlib
+# -----------------------------------
+from collections import OrderedDict
+
+import numpy as np
+
+OBS_HEIGHT = 60
+OBS_WIDTH = 80
+
+# grayscale levels of the matplotlib colours used by car_sim_env,
+# as produced by PIL's 'L' conversion (R*299 + G*587 + B*114) / 1000
+WHITE = 255
+BLUE = 29
+RED = 76
+BLACK = 0
+BROWN = 78
+
+# low byte of each 16-bit half of a uint32
+_LANES = np.uint32(0x00FF00FF)
+
+
+def _block_sums(x, rows, cols):
+    # sums of a 2-D array over the blocks starting at rows x cols
+    h, w = x.shape
+    fy, fx = h // len(rows), w // len(cols)
+    if fy * len(rows) != h or fx * len(cols) != w:
+        return np.add.reduceat(np.add.reduceat(x, rows, axis=0), cols, axis=1)
+    # equal blocks: strided adds, much faster than reduceat
+    by_row = x[0::fy].copy()
+    for k in range(1, fy):
+        by_row += x[k::fy]
+    by_row = by_row.reshape(len(rows), len(cols), fx)
+    sums = by_row[:, :, 0].copy()
+    for k in range(1, fx):
+        sums += by_row[:, :, k]
+    return sums
+
+
+def rgba_to_observation(rgba, height=OBS_HEIGHT, width=OBS_WIDTH):
+    '''
+    Grayscale and area downsample of an (H, W, 4) uint8 RGBA canvas in one
+    integer pass: the mean of PIL's 'L' luma (R*299 + G*587 + B*114) / 1000
+    over the block of canvas pixels behind each output pixel, rounded.
+    Returns a contiguous (height, width) uint8 array.
+
+    Each pixel is read as one uint32 and masked into two words holding
+    R, B and G, A in 16-bit lanes, so a block of up to 257 pixels sums
+    without a lane carrying into the next. Larger blocks are summed one
+    channel at a time instead.
+    '''
+    rgba = np.ascontiguousarray(rgba, dtype=np.uint8)
+    h, w = rgba.shape[:2]
+    rows = np.arange(height) * h // height
+    cols = np.arange(width) * w // width
+    counts = np.outer(np.diff(np.append(rows, h)), np.diff(np.append(cols, w)))
+
+    if counts.max() * 255 <= 0xFFFF:
+        pixels = rgba.view('<u4').reshape(h, w)
+        red_blue = _block_sums(pixels & _LANES, rows, cols)
+        green = _block_sums((pixels >> 8) & _LANES, rows, cols) & 0xFFFF
+        red, blue = red_blue & 0xFFFF, red_blue >> 16
+    else:
+        red, green, blue = [_block_sums(rgba[..., c].astype(np.uint32), rows, cols) for c in range(3)]
+    luma = red.astype(np.uint64) * 299 + green.astype(np.uint64) * 587 + blue.astype(np.uint64) * 114
+    counts = counts.astype(np.uint64) * 1000
+    return ((luma + counts // 2) // counts).astype(np.uint8)
+
+
+class NumpyRenderer(object):
+    '''
+    Rasterizes the static layout and the agent into a uint8 image.
+    The view is centred on the wall and flipped on both axes, like the
+    matplotlib figure after plt_show() inverts its x and y axes.
+
+    render() is incremental: the static layout is rasterized once into
+    self.background, and each call only restores the window the previous
+    agent covered and draws the agent again into a scratch canvas kept
+    between calls. The result is identical to render_full().
+    '''
+    def __init__(self, wall_verts, car_verts_list, height=OBS_HEIGHT, width=OBS_WIDTH,
+                 margin=3.0, wall_line_width=0.23, supersample=1):
+        self.height = height
+        self.width = width
+        self.supersample = supersample
+        self.wall_verts = np.asarray(wall_verts, dtype=np.float64)
+        self.car_verts_list = [np.asarray(v, dtype=np.float64) for v in car_verts_list]
+        self.wall_line_width = wall_line_width
+
+        # world -> pixel transform (pixels per world unit, on the supersampled grid)
+        wall_min = self.wall_verts.min(axis=0)
+        wall_max = self.wall_verts.max(axis=0)
+        self.view_center = (wall_min + wall_max) / 2.0
+        extent = wall_max - wall_min + 2 * margin
+        self.grid_h = height * supersample
+        self.grid_w = width * supersample
+        self.scale = min(self.grid_w / extent[0], self.grid_h / extent[1])
+
+        # world coordinates of every pixel centre, one vector per axis
+        self.col_x = self.view_center[0] - (np.arange(self.grid_w) + 0.5 - self.grid_w / 2.0) / self.scale
+        self.row_y = self.view_center[1] + (np.arange(self.grid_h) + 0.5 - self.grid_h / 2.0) / self.scale
+
+        self.background = np.empty((self.grid_h, self.grid_w), dtype=np.uint8)
+        self.draw_static(self.background)
+        self.scratch = self.background.copy()
+        self.dirty = None  # window of the agent drawn in scratch
+
+    def world_to_pixel(self, xy):
+        xy = np.asarray(xy, dtype=np.float64)
+        col = self.grid_w / 2.0 - (xy[..., 0] - self.view_center[0]) * self.scale
+        row = self.grid_h / 2.0 + (xy[..., 1] - self.view_center[1]) * self.scale
+        return row, col
+
+    def _pixel_window(self, verts, pad=0.0):
+        # pixel bounding box of a world-space shape, clipped to the canvas
+        row, col = self.world_to_pixel(verts)
+        pad_px = pad * self.scale
+        r0 = max(int(np.floor(row.min() - pad_px)), 0)
+        r1 = min(int(np.ceil(row.max() + pad_px)) + 1, self.grid_h)
+        c0 = max(int(np.floor(col.min() - pad_px)), 0)
+        c1 = min(int(np.ceil(col.max() + pad_px)) + 1, self.grid_w)
+        return r0, r1, c0, c1
+
+    def _edge_distance(self, verts, r0, r1, c0, c1):
+        '''
+        Signed distance (positive inside) of each pixel centre in the window
+        to the closest edge line of a convex polygon.
+        '''
+        xs = self.col_x[c0:c1][np.newaxis, :]
+        ys = self.row_y[r0:r1][:, np.newaxis]
+        n = len(verts)
+        area = 0.0
+        for i in range(n):
+            x1, y1 = verts[i]
+            x2, y2 = verts[(i + 1) % n]
+            area += x1 * y2 - x2 * y1
+        orientation = 1.0 if area >= 0 else -1.0
+
+        dist = None
+        for i in range(n):
+            x1, y1 = verts[i]
+            x2, y2 = verts[(i + 1) % n]
+            edge_len = np.hypot(x2 - x1, y2 - y1)
+            d = orientation * ((x2 - x1) * (ys - y1) - (y2 - y1) * (xs - x1)) / edge_len
+            dist = d if dist is None else np.minimum(dist, d)
+        return dist
+
+    def fill_polygon(self, canvas, verts, value):
+        verts = np.asarray(verts, dtype=np.float64)
+        r0, r1, c0, c1 = self._pixel_window(verts)
+        if r0 >= r1 or c0 >= c1:
+            return
+        inside = self._edge_distance(verts, r0, r1, c0, c1) >= 0
+        canvas[r0:r1, c0:c1][inside] = value
+
+    def stroke_polygon(self, canvas, verts, line_width, value):
+        verts = np.asarray(verts, dtype=np.float64)
+        # never thinner than one pixel, so the outline cannot fall between pixel centres
+        half = max(line_width / 2.0, 0.5 / self.scale)
+        r0, r1, c0, c1 = self._pixel_window(verts, pad=half)
+        if r0 >= r1 or c0 >= c1:
+            return
+        on_edge = np.abs(self._edge_distance(verts, r0, r1, c0, c1)) <= half
+        canvas[r0:r1, c0:c1][on_edge] = value
+
+    def fill_circle(self, canvas, center, radius, value):
+        center = np.asarray(center, dtype=np.float64)
+        box = np.array([center - radius, center + radius])
+        r0, r1, c0, c1 = self._pixel_window(box)
+        if r0 >= r1 or c0 >= c1:
+            return
+        dx = self.col_x[c0:c1][np.newaxis, :] - center[0]
+        dy = self.row_y[r0:r1][:, np.newaxis] - center[1]
+        inside = dx * dx + dy * dy <= radius * radius
+        canvas[r0:r1, c0:c1][inside] = value
+
+    def draw_static(self, canvas):
+        canvas.fill(WHITE)
+        self.stroke_polygon(canvas, self.wall_verts, self.wall_line_width, BLUE)
+        for car_verts in self.car_verts_list:
+            self.fill_polygon(canvas, car_verts, BLUE)
+
+    def draw_agent(self, canvas, agent_verts, head_xy, center_xy):
+        self.fill_polygon(canvas, agent_verts, RED)
+        self.fill_circle(canvas, head_xy, 0.03, BLACK)
+        self.fill_circle(canvas, center_xy, 0.02, BROWN)
+
+    def agent_window(self, agent_verts, head_xy, center_xy):
+        # pixel window holding every pixel draw_agent() can write
+        head_xy = np.asarray(head_xy, dtype=np.float64)
+        center_xy = np.asarray(center_xy, dtype=np.float64)
+        points = np.concatenate([np.asarray(agent_verts, dtype=np.float64),
+                                 [head_xy - 0.03, head_xy + 0.03, center_xy - 0.02, center_xy + 0.02]])
+        return self._pixel_window(points)
+
+    def downsample(self, canvas):
+        if self.supersample == 1:
+            return canvas
+        s = self.supersample
+        blocks = canvas.reshape(self.height, s, self.width, s).astype(np.uint16)
+        return (blocks.sum(axis=(1, 3)) // (s * s)).astype(np.uint8)
+
+    def _restore_background(self):
+        if self.dirty is not None:
+            r0, r1, c0, c1 = self.dirty
+            self.scratch[r0:r1, c0:c1] = self.background[r0:r1, c0:c1]
+
+    def render(self, agent_verts, head_xy, center_xy):
+        '''
+        Draws the agent over the cached background. With supersample=1 the
+        returned array is the scratch canvas itself, overwritten by the next
+        call; copy it to keep it.
+        '''
+        self._restore_background()
+        self.draw_agent(self.scratch, agent_verts, head_xy, center_xy)
+        self.dirty = self.agent_window(agent_verts, head_xy, center_xy)
+        return self.downsample(self.scratch)
+
+    def make_sprite(self, agent_verts, head_xy, center_xy):
+        '''
+        The pixels draw_agent() writes, as (window, mask, values): a bool
+        mask over the window and the values of its True pixels. Drawn into
+        a window of the scratch canvas set to WHITE, which no agent part
+        uses, and restored afterwards.
+        '''
+        window = self.agent_window(agent_verts, head_xy, center_xy)
+        r0, r1, c0, c1 = window
+        self._restore_background()
+        self.dirty = window
+        patch = self.scratch[r0:r1, c0:c1]
+        patch.fill(WHITE)
+        self.draw_agent(self.scratch, agent_verts, head_xy, center_xy)
+        mask = patch != WHITE
+        return window, mask, patch[mask]
+
+    def composite(self, sprite):
+        # render() for an agent given as a make_sprite() result
+        window, mask, values = sprite
+        self._restore_background()
+        r0, r1, c0, c1 = window
+        self.scratch[r0:r1, c0:c1][mask] = values
+        self.dirty = window
+        return self.downsample(self.scratch)
+
+    def render_full(self, agent_verts, head_xy, center_xy):
+        # redraws everything into a new array, the reference for render()
+        canvas = np.empty((self.grid_h, self.grid_w), dtype=np.uint8)
+        self.draw_static(canvas)
+        self.draw_agent(canvas, agent_verts, head_xy, center_xy)
+        return self.downsample(canvas)
+
+
+class SpriteCache(object):
+    '''
+    LRU cache of agent sprites (NumpyRenderer.make_sprite) keyed by the
+    pose quantized like car_sim_env.sense(): x and y rounded to
+    position_step, the heading to one of heading_bins directions. The
+    agent is drawn at the quantized pose, so an image can differ from
+    render() by the sub-step offset. At most capacity sprites are kept;
+    agent_shape(pose) gives the (agent_verts, head_xy, center_xy) to draw.
+    '''
+    def __init__(self, renderer, agent_shape, capacity=4096, position_step=0.1, heading_bins=16):
+        self.renderer = renderer
+        self.agent_shape = agent_shape
+        self.capacity = capacity
+        self.position_step = position_step
+        self.heading_bins = heading_bins
+        self.sprites = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, pose):
+        # sense()'s rounding: half-step cells, odd ones go to the next step
+        step = self.position_step
+        x = int(np.floor((np.floor(pose[0] / (step / 2)) + 1) / 2))
+        y = int(np.floor((np.floor(pose[1] / (step / 2)) + 1) / 2))
+        heading = int(np.floor((np.floor(pose[2] / (np.pi / self.heading_bins)) + 1) / 2)) % self.heading_bins
+        return x, y, heading
+
+    def get(self, pose):
+        key = self.key(pose)
+        sprite = self.sprites.pop(key, None)
+        if sprite is None:
+            self.misses += 1
+            x, y, heading = key
+            quantized = np.array([x * self.position_step, y * self.position_step,
+                                  heading * 2 * np.pi / self.heading_bins])
+            sprite = self.renderer.make_sprite(*self.agent_shape(quantized))
+            if len(self.sprites) >= self.capacity:
+                self.sprites.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+        self.sprites[key] = sprite  # most recently used last
+        return sprite
+
+    def render(self, pose):
+        return self.renderer.composite(self.get(pose))
+
+    def nbytes(self):
+        return sum(mask.nbytes + values.nbytes for _, mask, values in self.sprites.values())
+
+    def stats(self):
+        lookups = max(self.hits + self.misses, 1)
+        return {'entries': len(self.sprites), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': self.hits / float(lookups), 'bytes': self.nbytes()}
@@ -0,0 +1,28 @@
+# -----------------------------------
+# command line entry point: rlpark.py train|eval|bench [options]
+# only the module of the chosen command is imported
+# -----------------------------------
+import argparse
+import sys
+
+# command -> (module, help)
+COMMANDS = (('train', 'agent', 'train the DQN agent (options of agent.py)'),
+            ('eval', 'evaluate', 'greedy evaluation of a saved checkpoint (options of evaluate.py)'),
+            ('bench', 'bench', 'micro-benchmarks of the hot paths (options of bench.py)'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='rlpark.py', description='DQN automatic parking',
+                                     epilog='run "rlpark.py <command> --help" for the options of a command')
+    parser.add_argument('command', choices=[name for name, _, _ in COMMANDS],
+                        help='; '.join('{}: {}'.format(name, text) for name, _, text in COMMANDS))
+    parser.add_argument('options', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    opts = parser.parse_args(argv)
+
+    module_name = dict((name, module) for name, module, _ in COMMANDS)[opts.command]
+    module = __import__(module_name)
+    module.main(opts.options, prog='rlpark.py ' + opts.command)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,117 @@
+# -----------------------------------
+# leveled, buffered structured logging: one JSON record per line,
+# written in batches instead of a terminal write per step
+# -----------------------------------
+import atexit
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+LEVELS = {'trace': 5, 'debug': 10, 'info': 20, 'warning': 30}
+
+
+def _jsonable(value):
+    # numpy scalars/arrays and torch tensors, for json.dumps
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+class RunLogger(object):
+    '''
+    Keeps the records at or above level in memory and appends them to path
+    as JSON lines once buffer_size records are pending or flush_interval
+    seconds have passed since the last write. Without a path the records
+    are dropped.
+    '''
+    def __init__(self, path=None, level='info', buffer_size=256, flush_interval=5.0):
+        self.path = path
+        self.level = LEVELS[level]
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
+        self.file = open(path, 'a') if path else None
+        self.pid = os.getpid()
+
+    def enabled(self, level):
+        return self.file is not None and LEVELS[level] >= self.level
+
+    def log(self, level, event, fields):
+        if not self.enabled(level):
+            return
+        record = {'time': time.time(), 'level': level, 'event': event}
+        record.update(fields)
+        self.buffer.append(record)
+        if len(self.buffer) >= self.buffer_size or record['time'] - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.last_flush = time.time()
+            records, self.buffer = self.buffer, []
+            # a forked child drops what it inherited, the parent writes it
+            if self.file is None or not records or os.getpid() != self.pid:
+                return
+            self.file.write(''.join(json.dumps(r, default=_jsonable, sort_keys=True) + '\n' for r in records))
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+_logger = RunLogger()
+
+
+def configure(path=None, level='info', buffer_size=256, flush_interval=5.0):
+    '''
+    Replaces the process-wide logger, flushing the old one. Worker
+    processes call configure() without a path so that they do not write
+    into the buffer and file they inherited.
+    '''
+    global _logger
+    if _logger.file is not None:
+        _logger.close()
+    _logger = RunLogger(path, level, buffer_size, flush_interval)
+    return _logger
+
+
+def get_logger():
+    return _logger
+
+
+def tracing():
+    # guard for step-level records whose fields cost something to build
+    return _logger.enabled('trace')
+
+
+def trace(event, **fields):
+    _logger.log('trace', event, fields)
+
+
+def debug(event, **fields):
+    _logger.log('debug', event, fields)
+
+
+def info(event, **fields):
+    _logger.log('info', event, fields)
+
+
+def warning(event, **fields):
+    _logger.log('warning', event, fields)
+
+
+def flush():
+    _logger.flush()
+
+
+atexit.register(lambda: _logger.flush())
@@ -3,6 +3,9 @@
 # Author: Tao Chen
 # Date: 2016.10.28
 # -----------------------------------
+import os
+import json
+import threading
 import numpy as np
 
 import torch
@@ -10,9 +13,20 @@ import torch
 #import torch.nn.functional as F
 import random
 from collections import namedtuple
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward'))
 state = namedtuple('state', ('state_img', 'state_tuple'))
+# a collated minibatch; next_s_img/next_s_tuple only hold the non-final rows,
+# weight/index are only set by PrioritizedReplayMemory
+Batch = namedtuple('Batch', ('s_img', 's_tuple', 'action', 'reward',
+                             'non_final_mask', 'next_s_img', 'next_s_tuple',
+                             'weight', 'index'))
+Batch.__new__.__defaults__ = (None, None)
+
 class ReplayMemory(object):
     def __init__(self, capacity):
         self.capacity = capacity
@@ -32,11 +46,732 @@ class ReplayMemory(object):
 #                sample_t[0][1] = torch.cat(sample_t[0][1], self.memory[idx][0][1]), dim=0)
         return sample_t
 
+    def sample_batch(self, batch_size, device):
+        transitions = self.sample(batch_size)
+        batch = Transition(*zip(*transitions))
+
+        non_final_mask = torch.tensor(
+                tuple(map(lambda s: s is not None, batch.next_state)),
+                dtype=torch.uint8).to(device)
+        # pose-only observations carry no frames
+        frames = batch.state[0].state_img is not None
+        return Batch(
+                s_img = frame_to_float(torch.cat([s[0] for s in batch.state])) if frames else None,
+                s_tuple = torch.cat([s[1] for s in batch.state]).view(-1, 5),
+                action = torch.cat(batch.action).view(batch_size, -1),
+                reward = torch.cat(batch.reward),
+                non_final_mask = non_final_mask,
+                next_s_img = frame_to_float(torch.cat([s[0] for s in batch.next_state if s is not None])) if frames else None,
+                next_s_tuple = torch.cat([s[1] for s in batch.next_state if s is not None]).view(-1, 5)
+                )
+
+    def flush(self):
+        pass
+
+    def start_episode(self):
+        pass
+
+    def state_dict(self):
+        return {'memory': self.memory, 'position': self.position}
+
+    def load_state_dict(self, state_dict, device='cpu'):
+        '''
+        Checkpoints hold CPU tensors (checkpoint.snapshot): every transition
+        goes back to device, where push() would have put it.
+        '''
+        def restored_state(s):
+            if s is None:
+                return None
+            img = s.state_img.to(device) if s.state_img is not None else None
+            return s._replace(state_img=img, state_tuple=s.state_tuple.to(device))
+        self.memory = [t._replace(state=restored_state(t.state), action=t.action.to(device),
+                                  next_state=restored_state(t.next_state), reward=t.reward.to(device))
+                       for t in state_dict['memory']]
+        self.position = state_dict['position']
+
+    def __len__(self):
+        return len(self.memory)
+
+    def __getitem__(self, idx):
+        return self.memory[idx]
+
+
+def _to_numpy(x):
+    if torch.is_tensor(x):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def sample_without_replacement(n, k):
+    '''
+    k distinct indices in [0, n), like random.sample(range(n), k) but
+    O(k) for k << n: repeated draws are drawn again, where
+    np.random.choice(n, k, replace=False) would permute all n.
+    '''
+    if k > n:
+        raise ValueError('sample larger than population')
+    idx = np.unique(np.random.randint(0, n, k))
+    while len(idx) < k:
+        idx = np.unique(np.concatenate([idx, np.random.randint(0, n, k - len(idx))]))
+    np.random.shuffle(idx)
+    return idx
+
+
+def frame_to_uint8(img):
+    # uint8 frames (as produced by update_screen) pass through, [0, 1] float frames are scaled
+    img = _to_numpy(img)
+    if img.dtype == np.uint8:
+        return img
+    return np.clip(np.rint(img * 255.), 0, 255).astype(np.uint8)
+
+
+def frames_to_tensor(frames, device):
+    # uint8 frames -> float tensor in [0, 1] on device
+    return torch.from_numpy(frames).to(device).float().div_(255.)
+
+
+def frame_to_float(frames):
+    # uint8 frame tensors -> float in [0, 1], for the nets; float frames pass through
+    if frames.dtype == torch.uint8:
+        return frames.float().div_(255.)
+    return frames
+
+
+class ArrayReplayMemory(object):
+    '''
+    Replay memory in preallocated arrays: uint8 frames, float32 pose tuples,
+    int8 actions and float32 rewards. Minibatches are gathered by index and
+    returned as batched tensors, ready for the networks. With img_shape
+    None (pose-only observations) no frames are stored and the frames of
+    the batches are None.
+    '''
+    # the arrays allocate() creates, i.e. the whole state of the memory
+    array_names = ('counters', 'state_img', 'next_state_img', 'state_tuple', 'next_state_tuple',
+                   'action', 'reward', 'non_final')
+    frame_array_names = ('state_img', 'next_state_img')
+
+    def __init__(self, capacity, img_shape=(60, 80), vec_size=5):
+        self.capacity = capacity
+        self.img_shape = tuple(img_shape) if img_shape is not None else None
+        if self.img_shape is None:
+            self.array_names = tuple(name for name in self.array_names if name not in self.frame_array_names)
+        self.allocate(vec_size)
+
+    def allocate(self, vec_size):
+        capacity = self.capacity
+        # [position, size]
+        self.counters = self.new_array('counters', (2,), np.int64)
+        if self.img_shape is not None:
+            self.state_img = self.new_array('state_img', (capacity,) + self.img_shape, np.uint8)
+            self.next_state_img = self.new_array('next_state_img', (capacity,) + self.img_shape, np.uint8)
+        self.state_tuple = self.new_array('state_tuple', (capacity, vec_size), np.float32)
+        self.next_state_tuple = self.new_array('next_state_tuple', (capacity, vec_size), np.float32)
+        self.action = self.new_array('action', (capacity,), np.int8)
+        self.reward = self.new_array('reward', (capacity,), np.float32)
+        self.non_final = self.new_array('non_final', (capacity,), bool)
+
+    def new_array(self, name, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    @property
+    def position(self):
+        return int(self.counters[0])
+
+    @position.setter
+    def position(self, value):
+        self.counters[0] = value
+
+    @property
+    def size(self):
+        return int(self.counters[1])
+
+    @size.setter
+    def size(self, value):
+        self.counters[1] = value
+
+    def flush(self):
+        pass
+
+    def start_episode(self):
+        pass
+
+    def state_dict(self):
+        # the live arrays, not copies
+        return dict((name, getattr(self, name)) for name in self.array_names)
+
+    def load_state_dict(self, state_dict, device='cpu'):
+        # device: as in ReplayMemory; the arrays live on the CPU
+        for name in self.array_names:
+            getattr(self, name)[...] = state_dict[name]
+
+    def __len__(self):
+        return self.size
+
+    def push(self, state, action, next_state, reward):
+        i = self.position
+        if self.img_shape is not None:
+            self.state_img[i] = frame_to_uint8(state.state_img).reshape(self.img_shape)
+        self.state_tuple[i] = _to_numpy(state.state_tuple).reshape(-1)
+        self.action[i] = int(action)
+        self.reward[i] = float(reward)
+        self.non_final[i] = next_state is not None
+        if next_state is not None:
+            if self.img_shape is not None:
+                self.next_state_img[i] = frame_to_uint8(next_state.state_img).reshape(self.img_shape)
+            self.next_state_tuple[i] = _to_numpy(next_state.state_tuple).reshape(-1)
+
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample_indices(self, batch_size):
+        # uniform without replacement, like ReplayMemory.sample
+        return sample_without_replacement(self.size, batch_size)
+
+    def sample_batch(self, batch_size, device):
+        return self.gather(self.sample_indices(batch_size), device)
+
+    def frame_rows(self, idx, next_state=False):
+        # array holding the state (or next_state) frames of transitions idx, and their rows in it
+        return (self.next_state_img if next_state else self.state_img), idx
+
+    def batch_buffers(self, batch_size):
+        # host arrays gather_into() fills, one row per sampled transition
+        vec_size = self.state_tuple.shape[1]
+        buffers = {'s_tuple': np.zeros((batch_size, vec_size), dtype=np.float32),
+                   'action': np.zeros(batch_size, dtype=np.int64),
+                   'reward': np.zeros(batch_size, dtype=np.float32),
+                   'non_final': np.zeros(batch_size, dtype=np.uint8),
+                   'next_s_tuple': np.zeros((batch_size, vec_size), dtype=np.float32)}
+        if self.img_shape is not None:
+            buffers['s_img'] = np.zeros((batch_size,) + self.img_shape, dtype=np.uint8)
+            buffers['next_s_img'] = np.zeros((batch_size,) + self.img_shape, dtype=np.uint8)
+        return buffers
+
+    def gather_into(self, idx, out):
+        '''
+        Copies transitions idx into the batch_buffers() arrays of out. The
+        next states of the non-final transitions are packed at the front of
+        next_s_img/next_s_tuple; returns how many there are.
+        '''
+        non_final = self.non_final[idx]
+        next_idx = idx[non_final]
+        n_next = len(next_idx)
+        np.take(self.state_tuple, idx, axis=0, out=out['s_tuple'], mode='clip')
+        out['action'][:] = self.action[idx]
+        out['reward'][:] = self.reward[idx]
+        out['non_final'][:] = non_final
+        if self.img_shape is not None:
+            frames, rows = self.frame_rows(idx)
+            np.take(frames, rows, axis=0, out=out['s_img'], mode='clip')
+            frames, rows = self.frame_rows(next_idx, next_state=True)
+            np.take(frames, rows, axis=0, out=out['next_s_img'][:n_next], mode='clip')
+        np.take(self.next_state_tuple, next_idx, axis=0, out=out['next_s_tuple'][:n_next], mode='clip')
+        return n_next
+
+    def gather(self, idx, device):
+        out = self.batch_buffers(len(idx))
+        n_next = self.gather_into(idx, out)
+        frames = self.img_shape is not None
+        return Batch(
+                s_img = frames_to_tensor(out['s_img'], device) if frames else None,
+                s_tuple = torch.from_numpy(out['s_tuple']).to(device),
+                action = torch.from_numpy(out['action']).view(-1, 1).to(device),
+                reward = torch.from_numpy(out['reward']).to(device),
+                non_final_mask = torch.from_numpy(out['non_final']).to(device),
+                next_s_img = frames_to_tensor(out['next_s_img'][:n_next], device) if frames else None,
+                next_s_tuple = torch.from_numpy(out['next_s_tuple'][:n_next]).to(device)
+                )
+
+    def __getitem__(self, idx):
+        # one stored transition, in the tensor layout ReplayMemory keeps
+        frames = self.img_shape is not None
+        next_state = None
+        if self.non_final[idx]:
+            next_state = state(frames_to_tensor(self.next_state_img[idx:idx + 1], 'cpu') if frames else None,
+                               torch.from_numpy(self.next_state_tuple[idx].copy()))
+        return Transition(
+                state(frames_to_tensor(self.state_img[idx:idx + 1], 'cpu') if frames else None,
+                      torch.from_numpy(self.state_tuple[idx].copy())),
+                torch.LongTensor([int(self.action[idx])]),
+                next_state,
+                torch.Tensor([float(self.reward[idx])]))
+
+
+class MmapReplayMemory(ArrayReplayMemory):
+    '''
+    ArrayReplayMemory whose arrays are memory-mapped .npy files in root_dir,
+    so the capacity is bounded by disk instead of RAM and the OS page cache
+    keeps the hot part in memory. A buffer left in root_dir with the same
+    layout is reopened with its contents and counters, so a restarted run
+    starts with the transitions it had; a different layout is overwritten.
+    '''
+    def __init__(self, capacity, root_dir, img_shape=(60, 80), vec_size=5):
+        self.root_dir = root_dir
+        layout = {'capacity': capacity, 'img_shape': list(img_shape) if img_shape is not None else None,
+                  'vec_size': vec_size}
+        layout_path = os.path.join(root_dir, 'layout.json')
+
+        self.resumed = False
+        if os.path.isfile(layout_path):
+            with open(layout_path) as f:
+                self.resumed = json.load(f) == layout
+        if not os.path.isdir(root_dir):
+            os.makedirs(root_dir)
+        if not self.resumed and os.path.isfile(layout_path):
+            # invalidate the old buffer before its files get overwritten
+            os.remove(layout_path)
+
+        super(MmapReplayMemory, self).__init__(capacity, img_shape, vec_size)
+
+        if not self.resumed:
+            self.flush()
+            with open(layout_path, 'w') as f:
+                json.dump(layout, f)
+
+    def new_array(self, name, shape, dtype):
+        path = os.path.join(self.root_dir, name + '.npy')
+        if self.resumed:
+            return np.lib.format.open_memmap(path, mode='r+')
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+    def flush(self):
+        for name in self.array_names:
+            getattr(self, name).flush()
+
+    def state_dict(self):
+        # the arrays already persist in root_dir, kept current by flush()
+        return {}
+
+    def load_state_dict(self, state_dict, device='cpu'):
+        if state_dict:
+            super(MmapReplayMemory, self).load_state_dict(state_dict, device)
+
+
+class DedupReplayMemory(ArrayReplayMemory):
+    '''
+    ArrayReplayMemory that stores each rendered frame once. Transitions refer
+    to their state and next_state frames by id, so consecutive transitions
+    of an episode share the frame that is the next_state of one and the
+    state of the other. A None next_state marks a terminal transition and
+    ends the episode, as does start_episode(): the following push stores
+    its state frame anew.
+    Frames live in a ring of frame_capacity slots; transitions whose state
+    frame has been overwritten are dropped from the memory.
+    With stack > 1 the states are stacks of the last stack frames (see
+    FrameStack): only the newest frame of each is stored, and the stacks are
+    rebuilt at sample time from the frames before it, the first frame of
+    the episode standing in for those before the episode start.
+    '''
+    array_names = ('counters', 'frames', 'frame_start', 'state_frame', 'next_frame', 'state_tuple',
+                   'next_state_tuple', 'action', 'reward', 'non_final')
+
+    def __init__(self, capacity, frame_capacity=None, img_shape=(60, 80), vec_size=5, stack=1):
+        self.frame_capacity = frame_capacity or capacity + stack
+        self.stack = stack
+        # id of the last stored next_state frame, None at the start of an episode
+        self.last_frame = None
+        super(DedupReplayMemory, self).__init__(capacity, img_shape, vec_size)
+
+    def allocate(self, vec_size):
+        capacity = self.capacity
+        # [pushes, frames written, first valid push]; frame ids and push ids
+        # only grow, their ring slots are id % frame_capacity and id % capacity
+        self.counters = self.new_array('counters', (3,), np.int64)
+        self.frames = self.new_array('frames', (self.frame_capacity,) + self.img_shape, np.uint8)
+        # id of the first frame of the episode each frame belongs to
+        self.frame_start = self.new_array('frame_start', (self.frame_capacity,), np.int64)
+        self.state_frame = self.new_array('state_frame', (capacity,), np.int64)
+        self.next_frame = self.new_array('next_frame', (capacity,), np.int64)
+        self.state_tuple = self.new_array('state_tuple', (capacity, vec_size), np.float32)
+        self.next_state_tuple = self.new_array('next_state_tuple', (capacity, vec_size), np.float32)
+        self.action = self.new_array('action', (capacity,), np.int8)
+        self.reward = self.new_array('reward', (capacity,), np.float32)
+        self.non_final = self.new_array('non_final', (capacity,), bool)
+
+    @property
+    def position(self):
+        return int(self.counters[0]) % self.capacity
+
+    @property
+    def size(self):
+        return int(self.counters[0] - self.counters[2])
+
+    def state_dict(self):
+        state_dict = super(DedupReplayMemory, self).state_dict()
+        state_dict['last_frame'] = self.last_frame
+        return state_dict
+
+    def load_state_dict(self, state_dict, device='cpu'):
+        super(DedupReplayMemory, self).load_state_dict(state_dict, device)
+        self.last_frame = state_dict['last_frame']
+
+    def start_episode(self):
+        # the next state frame starts an episode, even if it equals the last stored one
+        self.last_frame = None
+
+    def newest_frame(self, img):
+        # a state's frame, or the newest frame of its stack
+        return frame_to_uint8(img).reshape((-1,) + self.img_shape)[-1]
+
+    def write_frame(self, frame, episode_start=None):
+        # episode_start None: the frame starts an episode
+        frame_id = int(self.counters[1])
+        self.frames[frame_id % self.frame_capacity] = frame
+        self.frame_start[frame_id % self.frame_capacity] = frame_id if episode_start is None else episode_start
+        self.counters[1] = frame_id + 1
+        return frame_id
+
+    def push(self, state, action, next_state, reward):
+        frame = self.newest_frame(state.state_img)
+        if self.last_frame is not None and \
+                np.array_equal(self.frames[self.last_frame % self.frame_capacity], frame):
+            state_frame = self.last_frame
+        else:
+            state_frame = self.write_frame(frame)
+
+        i = self.position
+        self.state_frame[i] = state_frame
+        self.state_tuple[i] = _to_numpy(state.state_tuple).reshape(-1)
+        self.action[i] = int(action)
+        self.reward[i] = float(reward)
+        self.non_final[i] = next_state is not None
+        if next_state is not None:
+            self.last_frame = self.write_frame(self.newest_frame(next_state.state_img),
+                                               self.frame_start[state_frame % self.frame_capacity])
+            self.next_frame[i] = self.last_frame
+            self.next_state_tuple[i] = _to_numpy(next_state.state_tuple).reshape(-1)
+        else:
+            self.last_frame = None
+            self.next_frame[i] = -1
+
+        pushes = int(self.counters[0]) + 1
+        self.counters[0] = pushes
+        # drop the transitions that fell out of the ring or lost a frame of their state
+        first = max(int(self.counters[2]), pushes - self.capacity)
+        oldest_frame = int(self.counters[1]) - self.frame_capacity + self.stack - 1
+        while first < pushes and self.state_frame[first % self.capacity] < oldest_frame:
+            first += 1
+        self.counters[2] = first
+
+    def sample_indices(self, batch_size):
+        return (int(self.counters[2]) + sample_without_replacement(self.size, batch_size)) % self.capacity
+
+    def frame_rows(self, idx, next_state=False):
+        frame_ids = (self.next_frame if next_state else self.state_frame)[idx]
+        if self.stack > 1:
+            # (len(idx), stack) ids of the stacks ending at frame_ids, clamped to their episode start
+            starts = self.frame_start[frame_ids % self.frame_capacity]
+            frame_ids = np.maximum(frame_ids[:, None] - np.arange(self.stack - 1, -1, -1), starts[:, None])
+        return self.frames, frame_ids % self.frame_capacity
+
+    def batch_buffers(self, batch_size):
+        buffers = super(DedupReplayMemory, self).batch_buffers(batch_size)
+        if self.stack > 1:
+            for name in ('s_img', 'next_s_img'):
+                buffers[name] = np.zeros((batch_size, self.stack) + self.img_shape, dtype=np.uint8)
+        return buffers
+
+    def stored_state_img(self, slot, next_state=False):
+        frames, rows = self.frame_rows(np.array([slot]), next_state)
+        return frames_to_tensor(frames[rows].reshape((-1,) + self.img_shape), 'cpu')
+
+    def __getitem__(self, idx):
+        # idx counts from the oldest stored transition
+        slot = (int(self.counters[2]) + idx) % self.capacity
+        next_state = None
+        if self.non_final[slot]:
+            next_state = state(self.stored_state_img(slot, next_state=True),
+                               torch.from_numpy(self.next_state_tuple[slot].copy()))
+        return Transition(
+                state(self.stored_state_img(slot),
+                      torch.from_numpy(self.state_tuple[slot].copy())),
+                torch.LongTensor([int(self.action[slot])]),
+                next_state,
+                torch.Tensor([float(self.reward[slot])]))
+
+
+class FrameStack(object):
+    '''
+    The last k frames as one (k,) + frame_shape tensor, oldest first. The
+    frames go into a ring of k + 1 slots kept twice over, back to back, so
+    the latest k are always one contiguous slice: push() copies the frame
+    into both halves and returns a view, nothing is concatenated. A stack
+    returned by push() or reset() stays valid through the following push,
+    which is what a transition needs, and is overwritten after that.
+    '''
+    def __init__(self, k, frame_shape=(60, 80), device='cpu', dtype=torch.uint8):
+        self.k = k
+        self.slots = k + 1
+        self.buffer = torch.zeros((2 * self.slots,) + tuple(frame_shape), dtype=dtype, device=device)
+        self.count = 0
+
+    def reset(self, frame):
+        # first frame of an episode: it fills the whole stack
+        self.count = 0
+        for _ in range(self.k):
+            self.push(frame)
+        return self.view()
+
+    def push(self, frame):
+        i = self.count % self.slots
+        frame = frame.view(self.buffer.shape[1:])
+        self.buffer[i].copy_(frame)
+        self.buffer[i + self.slots].copy_(frame)
+        self.count += 1
+        return self.view()
+
+    def view(self):
+        start = (self.count - self.k) % self.slots
+        return self.buffer[start:start + self.k]
+
+
+class SumTree(object):
+    '''
+    Binary tree in a flat array: the leaves hold the priorities and every
+    inner node the sum of its two children, the root (tree[1]) the total.
+    Leaf i lives at tree[size + i]. Updates and prefix-sum lookups walk one
+    level at a time for a whole batch of indices, O(log n) numpy steps.
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 1
+        self.depth = 0
+        while self.size < capacity:
+            self.size *= 2
+            self.depth += 1
+        self.tree = np.zeros(2 * self.size, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idx):
+        return self.tree[np.asarray(idx) + self.size]
+
+    def update(self, idx, priorities):
+        nodes = np.asarray(idx, dtype=np.int64).reshape(-1) + self.size
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        # leaf index whose prefix-sum interval contains each value
+        values = np.minimum(np.asarray(values, dtype=np.float64), np.nextafter(self.total(), 0))
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values >= self.tree[left]
+            values = np.where(go_right, values - self.tree[left], values)
+            nodes = np.where(go_right, left + 1, left)
+        return nodes - self.size
+
+
+class PrioritizedReplayMemory(object):
+    '''
+    Proportional prioritized replay over an ArrayReplayMemory or
+    MmapReplayMemory. Slots are drawn with probability p^alpha / sum(p^alpha)
+    through a SumTree, in batch_size equal strata, and the batch carries the
+    importance-sampling weights (N * P(i))^-beta normalized by their max,
+    with beta annealed to 1 over beta_steps batches. New transitions get the
+    highest priority seen so far; update_priorities() sets |TD error| + eps.
+    '''
+    def __init__(self, memory, alpha=0.6, beta=0.4, beta_steps=100000, eps=1e-6):
+        self.memory = memory
+        self.alpha = alpha
+        self.beta_start = beta
+        self.beta_steps = beta_steps
+        self.eps = eps
+        self.tree = SumTree(memory.capacity)
+        self.max_priority = 1.0
+        self.n_batches = 0
+        if len(memory) > 0:
+            # resumed buffer: no priorities yet, give every transition the max
+            self.tree.update(np.arange(len(memory)), self.max_priority ** self.alpha)
+
+    def __len__(self):
+        return len(self.memory)
+
+    def __getitem__(self, idx):
+        return self.memory[idx]
+
+    def flush(self):
+        self.memory.flush()
+
+    def start_episode(self):
+        self.memory.start_episode()
+
+    def state_dict(self):
+        return {'memory': self.memory.state_dict(), 'tree': self.tree.tree,
+                'max_priority': self.max_priority, 'n_batches': self.n_batches}
+
+    def load_state_dict(self, state_dict, device='cpu'):
+        self.memory.load_state_dict(state_dict['memory'], device)
+        self.tree.tree[...] = state_dict['tree']
+        self.max_priority = state_dict['max_priority']
+        self.n_batches = state_dict['n_batches']
+
+    def push(self, *args):
+        slot = self.memory.position
+        self.memory.push(*args)
+        self.tree.update([slot], self.max_priority ** self.alpha)
+
+    def beta(self):
+        return self.beta_start + (1.0 - self.beta_start) * min(1.0, self.n_batches / float(self.beta_steps))
+
+    def batch_buffers(self, batch_size):
+        return self.memory.batch_buffers(batch_size)
+
+    def gather_into(self, idx, out):
+        return self.memory.gather_into(idx, out)
+
+    def sample_indices(self, batch_size):
+        total = self.tree.total()
+        bounds = np.linspace(0, total, batch_size + 1)
+        idx = self.tree.find(np.random.uniform(bounds[:-1], bounds[1:]))
+        return np.minimum(idx, len(self.memory) - 1)
+
+    def importance_weights(self, idx):
+        # float32 weights of a batch drawn by sample_indices(), advances the beta schedule
+        probs = self.tree.get(idx) / self.tree.total()
+        weights = (len(self.memory) * probs) ** -self.beta()
+        weights /= weights.max()
+        self.n_batches += 1
+        return weights.astype(np.float32)
+
+    def sample_batch(self, batch_size, device):
+        idx = self.sample_indices(batch_size)
+        weights = self.importance_weights(idx)
+        batch = self.memory.gather(idx, device)
+        return batch._replace(weight=torch.from_numpy(weights).to(device), index=idx)
+
+    def update_priorities(self, idx, td_errors):
+        priorities = np.abs(td_errors) + self.eps
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(idx, priorities ** self.alpha)
+
+
+class BatchPrefetcher(object):
+    '''
+    Builds minibatches on a background thread, up to depth of them ahead of
+    the learner; get() only ever returns a finished batch. Batches are
+    gathered into a ring of depth + 2 preallocated slots that are reused in
+    turn, so a slot is refilled only after the learner has moved on to the
+    next batch. On a CUDA device the slots are pinned host buffers copied
+    asynchronously; on the CPU the batch tensors are the slots themselves,
+    frames included. The memory is read under lock, shared with whoever
+    pushes to it.
+    '''
+    def __init__(self, memory, batch_size, device, depth=2, lock=None):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.lock = lock or threading.Lock()
+        self.pinned = self.device.type == 'cuda'
+        self.weighted = hasattr(memory, 'importance_weights')
+        self.slots = [self.new_slot() for _ in range(depth + 2)]
+        self.ready = queue.Queue(maxsize=depth)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='prefetcher')
+        self.thread.daemon = True
+
+    def new_slot(self):
+        tensors = {}
+        for name, array in self.memory.batch_buffers(self.batch_size).items():
+            tensors[name] = torch.from_numpy(array)
+            if self.pinned:
+                tensors[name] = tensors[name].pin_memory()
+        slot = {'tensors': tensors,
+                # numpy views of the tensors, written by gather_into
+                'arrays': dict((name, t.numpy()) for name, t in tensors.items())}
+        if self.pinned:
+            slot['copied'] = torch.cuda.Event()
+        elif 's_img' in tensors:
+            slot['s_img'] = torch.zeros(tensors['s_img'].shape)
+            slot['next_s_img'] = torch.zeros(tensors['next_s_img'].shape)
+        return slot
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        # unblock a pending put()
+        while self.thread.is_alive():
+            try:
+                self.ready.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(timeout=0.01)
+
+    def get(self):
+        return self.ready.get()
+
+    def run(self):
+        k = 0
+        while not self.stop_event.is_set():
+            if len(self.memory) < self.batch_size:
+                self.stop_event.wait(0.01)
+                continue
+            slot = self.slots[k % len(self.slots)]
+            if self.pinned:
+                # the last copy out of this slot must be done before it is overwritten
+                slot['copied'].synchronize()
+            with self.lock:
+                idx = self.memory.sample_indices(self.batch_size)
+                n_next = self.memory.gather_into(idx, slot['arrays'])
+                weight = self.memory.importance_weights(idx) if self.weighted else None
+            batch = self.to_batch(slot, n_next, weight, idx if self.weighted else None)
+            while not self.stop_event.is_set():
+                try:
+                    self.ready.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            k += 1
+
+    def to_batch(self, slot, n_next, weight, index):
+        t = slot['tensors']
+        frames = 's_img' in t
+        if weight is not None:
+            weight = torch.from_numpy(weight).to(self.device)
+        if self.pinned:
+            def upload(x):
+                return x.to(self.device, non_blocking=True)
+            batch = Batch(
+                    s_img = upload(t['s_img']).float().div_(255.) if frames else None,
+                    s_tuple = upload(t['s_tuple']),
+                    action = upload(t['action']).view(-1, 1),
+                    reward = upload(t['reward']),
+                    non_final_mask = upload(t['non_final']),
+                    next_s_img = upload(t['next_s_img'][:n_next]).float().div_(255.) if frames else None,
+                    next_s_tuple = upload(t['next_s_tuple'][:n_next]),
+                    weight = weight,
+                    index = index)
+            slot['copied'].record()
+            return batch
+        # in place into the slot's float frames, nothing is allocated
+        s_img = next_s_img = None
+        if frames:
+            s_img = slot['s_img'].copy_(t['s_img']).div_(255.)
+            next_s_img = slot['next_s_img'][:n_next]
+            next_s_img.copy_(t['next_s_img'][:n_next]).div_(255.)
+        return Batch(
+                s_img = s_img,
+                s_tuple = t['s_tuple'],
+                action = t['action'].view(-1, 1),
+                reward = t['reward'],
+                non_final_mask = t['non_final'],
+                next_s_img = next_s_img,
+                next_s_tuple = t['next_s_tuple'][:n_next],
+                weight = weight,
+                index = index)
+
 
 def print_log(print_string, log):
+    # the log file is flushed by the callers at report boundaries, not per line
     print("{}".format(print_string))
     log.write('{}\n'.format(print_string))
-    log.flush()
 
 def get_line_coeffi(point1, point2):
     if point1[0] == point2[0]:
@@ -82,3 +817,110 @@ def two_rects_intersect(rect1_verts, rect2_verts):
                 else:
                     continue
     return False
+
+
+def rects_intersect_batch(rects, rect, tolerance=1e-5):
+    '''
+    Vectorized two_rects_intersect: tests whether any edge of each of the
+    (N, 4, 2) rects crosses an edge of the (4, 2) rect.
+    Returns an (N,) bool array.
+    '''
+    rects = np.asarray(rects, dtype=np.float64)
+    rect = np.asarray(rect, dtype=np.float64)
+    # every edge of rects (axis 1) against every edge of rect (axis 2)
+    p1 = rects[:, :, np.newaxis, :]
+    p2 = np.roll(rects, -1, axis=1)[:, :, np.newaxis, :]
+    q1 = rect[np.newaxis, np.newaxis, :, :]
+    q2 = np.roll(rect, -1, axis=0)[np.newaxis, np.newaxis, :, :]
+    d1 = p2 - p1
+    d2 = q2 - q1
+
+    denom = d1[..., 0] * d2[..., 1] - d1[..., 1] * d2[..., 0]
+    parallel = np.abs(denom) < tolerance * np.linalg.norm(d1, axis=-1) * np.linalg.norm(d2, axis=-1)
+    denom = np.where(parallel, 1.0, denom)
+    w = q1 - p1
+    t = (w[..., 0] * d2[..., 1] - w[..., 1] * d2[..., 0]) / denom
+    # intersection point of the two edge lines
+    x = p1[..., 0] + t * d1[..., 0]
+    y = p1[..., 1] + t * d1[..., 1]
+
+    on_edge1 = ((x - p1[..., 0]) * (x - p2[..., 0]) <= tolerance) & \
+               ((y - p1[..., 1]) * (y - p2[..., 1]) <= tolerance)
+    on_edge2 = ((x - q1[..., 0]) * (x - q2[..., 0]) <= tolerance) & \
+               ((y - q1[..., 1]) * (y - q2[..., 1]) <= tolerance)
+    crossing = on_edge1 & on_edge2 & ~parallel
+    return crossing.reshape(len(rects), -1).any(axis=1)
+
+
+def sat_rects_intersect(rects1, rects2, radius1=None, radius2=None, tolerance=1e-5):
+    '''
+    Separating-axis overlap test of every (M, 4, 2) rect in rects1 against
+    every (K, 4, 2) rect in rects2. Returns an (M, K) bool array.
+    Unlike two_rects_intersect, a rect lying fully inside the other one
+    counts as overlapping.
+    radius1/radius2 are the bounding-circle radii around each rect's centre
+    used by the broad phase (scalars or per-rect arrays); pairs whose
+    centres are further apart than radius1 + radius2 are culled before the
+    narrow phase. They are computed from the vertices when not given.
+    '''
+    rects1 = np.asarray(rects1, dtype=np.float64).reshape(-1, 4, 2)
+    rects2 = np.asarray(rects2, dtype=np.float64).reshape(-1, 4, 2)
+    centers1 = rects1.mean(axis=1)
+    centers2 = rects2.mean(axis=1)
+    if radius1 is None:
+        radius1 = np.linalg.norm(rects1 - centers1[:, np.newaxis, :], axis=2).max(axis=1)
+    if radius2 is None:
+        radius2 = np.linalg.norm(rects2 - centers2[:, np.newaxis, :], axis=2).max(axis=1)
+    radius1 = np.broadcast_to(radius1, (len(rects1),))
+    radius2 = np.broadcast_to(radius2, (len(rects2),))
+
+    # broad phase: bounding circles
+    center_dist = np.linalg.norm(centers1[:, np.newaxis, :] - centers2[np.newaxis, :, :], axis=2)
+    result = np.zeros((len(rects1), len(rects2)), dtype=bool)
+    idx1, idx2 = np.nonzero(center_dist <= radius1[:, np.newaxis] + radius2[np.newaxis, :] + tolerance)
+    if len(idx1) == 0:
+        return result
+
+    # narrow phase: the two edge normals of each rect are the candidate axes
+    a = rects1[idx1]
+    b = rects2[idx2]
+    edges = np.concatenate((a[:, 1:3] - a[:, 0:2], b[:, 1:3] - b[:, 0:2]), axis=1)
+    axes = np.stack((-edges[..., 1], edges[..., 0]), axis=-1)
+    axes /= np.linalg.norm(axes, axis=-1, keepdims=True)
+    proj_a = np.einsum('pvd,pad->pav', a, axes)
+    proj_b = np.einsum('pvd,pad->pav', b, axes)
+    separated = (proj_a.max(axis=2) < proj_b.min(axis=2) - tolerance) | \
+                (proj_b.max(axis=2) < proj_a.min(axis=2) - tolerance)
+    result[idx1, idx2] = ~separated.any(axis=1)
+    return result
+
+
+def _rect_contains(outer, inner):
+    # True if every vertex of inner lies inside the convex rect outer
+    edges = np.roll(outer, -1, axis=0) - outer
+    rel = inner[:, np.newaxis, :] - outer[np.newaxis, :, :]
+    cross = edges[np.newaxis, :, 0] * rel[..., 1] - edges[np.newaxis, :, 1] * rel[..., 0]
+    return bool(np.all(cross > 0) or np.all(cross < 0))
+
+
+def _sat_regression_forTest(n_pairs=5000, seed=0):
+    '''
+    Compares sat_rects_intersect with two_rects_intersect on random rotated
+    rectangles. Pairs where one rect contains the other are skipped, since
+    only the SAT kernel reports those. Returns the number of disagreements.
+    '''
+    rng = np.random.RandomState(seed)
+    mismatches = 0
+    for _ in range(n_pairs):
+        rects = []
+        for _ in range(2):
+            half = rng.uniform(0.2, 3.0, 2)
+            angle = rng.uniform(0, 2 * np.pi)
+            local = np.array([[-half[0], half[1]], [half[0], half[1]], [half[0], -half[1]], [-half[0], -half[1]]])
+            rotation_mtx = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+            rects.append(np.dot(rotation_mtx, local.T).T + rng.uniform(-4, 4, 2))
+        if _rect_contains(rects[0], rects[1]) or _rect_contains(rects[1], rects[0]):
+            continue
+        if two_rects_intersect(rects[0], rects[1]) != sat_rects_intersect(rects[0], rects[1])[0, 0]:
+            mismatches += 1
+    return mismatches